@@ -9,6 +9,7 @@ import os
 import re
 from datetime import time
 from dotenv import load_dotenv
+from cachetools import LRUCache
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
@@ -18,9 +19,10 @@ from telegram.ext import Application, MessageHandler, CommandHandler, ChatMember
 
 # --- 内部模块导入 ---
 from src.database import init_database, get_session_factory, Rule
-from src.core.parser import RuleParser
+from src.core.parser import parse_rule
 from src.utils import session_scope
 from src.bot.handlers import (
+    RULE_CACHE_MAXSIZE,
     message_handler,
     command_handler,
     user_join_handler,
@@ -68,7 +70,7 @@ async def load_scheduled_rules(application: Application):
             for rule in rules:
                 try:
                     # 解析规则以检查是否为 `schedule` 类型的触发器
-                    parsed_rule = RuleParser(rule.script).parse()
+                    parsed_rule = parse_rule(rule.script)
                     if not parsed_rule.when_events:
                         continue
 
@@ -159,13 +161,17 @@ async def main():
     logger.info("正在启动机器人应用...")
     # 核心修复：在构建 Application 时传入 job_queue
     # 这会将 job_queue 和 application 深度集成，从而自动处理 context
+    # 注意：不开启 concurrent_updates。各处理器在 await 期间持有同步的 SQLAlchemy 会话，
+    # 并发处理更新会让阻塞的数据库调用（行锁/唯一约束等待）卡住整个事件循环，
+    # 验证回调等处理器之间也会出现竞争，因此更新按顺序逐个处理。
     application = Application.builder().token(token).job_queue(job_queue).build()
 
     # --- 5. 设置全局应用上下文 (Bot Data) ---
     # 这是机器人的“全局内存”，用于在不同的回调和模块之间共享状态和对象，
     # 例如数据库会话工厂和规则缓存。
     application.bot_data['session_factory'] = session_factory
-    application.bot_data['rule_cache'] = {}
+    # 规则缓存使用有容量上限的 LRU 缓存，避免在加入大量群组后无限增长
+    application.bot_data['rule_cache'] = LRUCache(maxsize=RULE_CACHE_MAXSIZE)
     application.bot_data['media_group_aggregator'] = {}
     application.bot_data['media_group_jobs'] = {}
 
@@ -17,10 +17,11 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatPer
 from telegram.ext import ContextTypes
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.orm.exc import NoResultFound
+from cachetools import LRUCache
 
 
 from src.utils import session_scope, generate_math_image, unmute_user_util
-from src.core.parser import RuleParser, RuleParserError
+from src.core.parser import RuleParserError, parse_rule
 from src.core.executor import RuleExecutor, StopRuleProcessing
 from src.database import Rule, Verification, EventLog, get_session_factory, User, Group
 from sqlalchemy import create_engine
@@ -28,6 +29,13 @@ from .default_rules import DEFAULT_RULES
 
 logger = logging.getLogger(__name__)
 
+# 规则缓存 (`bot_data['rule_cache']`) 最多同时保存多少个群组的已解析规则。
+RULE_CACHE_MAXSIZE = 1024
+
+# 为 True 时 `_seed_rules_if_new_group` 直接返回 False，不检查也不植入默认规则。
+# 供测试使用 (见 tests/conftest.py 中的 `no_seed` 标记)，生产环境中应始终保持为 False。
+_SEED_DISABLED = False
+
 # =================== 辅助函数 ===================
 
 def _get_or_create_user(db_session: Session, user: TelegramUser) -> User:
@@ -60,11 +68,22 @@ async def _is_user_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         logger.error(f"无法获取用户 {update.effective_user.id} 的管理员状态: {e}")
         return False
 
+async def _kick_user(context: ContextTypes.DEFAULT_TYPE, group_id: int, user_id: int):
+    """
+    将用户移出群组：先封禁再立即解封，这样用户之后仍可以重新加入。
+    两个请求必须按顺序发出：如果解封先于封禁被 Telegram 处理，用户将被永久封禁。
+    """
+    await context.bot.ban_chat_member(chat_id=group_id, user_id=user_id)
+    await context.bot.unban_chat_member(chat_id=group_id, user_id=user_id)
+
 def _seed_rules_if_new_group(chat_id: int, db_session: Session) -> bool:
     """
     检查群组是否存在，如果不存在则创建。然后检查群组是否有规则，如果没有，则为其植入默认规则集。
     这个函数现在更加健壮，可以处理数据库被清空但机器人仍在群组内的情况。
     """
+    if _SEED_DISABLED:
+        return False
+
     # 首先，确保群组记录存在于数据库中
     group = db_session.query(Group).filter_by(id=chat_id).first()
     if not group:
@@ -114,7 +133,13 @@ async def process_event(event_type: str, update: Update, context: ContextTypes.D
 
     chat_id = update.effective_chat.id
     session_factory: sessionmaker = context.bot_data['session_factory']
-    rule_cache: dict = context.bot_data.get('rule_cache', {})
+    # 代码评审意见:
+    # - [性能优化] 规则缓存使用有容量上限的 LRUCache，而不是无限增长的 dict。
+    #   机器人加入大量群组时，只有最近活跃的群组会常驻内存，不活跃群组的 AST 会被自动淘汰，
+    #   下次事件到来时再按需重新加载（解析结果仍可命中 `parse_rule` 的缓存）。
+    if 'rule_cache' not in context.bot_data:
+        context.bot_data['rule_cache'] = LRUCache(maxsize=RULE_CACHE_MAXSIZE)
+    rule_cache: LRUCache = context.bot_data['rule_cache']
 
     try:
         with session_scope(session_factory) as db_session:
@@ -140,6 +165,8 @@ async def process_event(event_type: str, update: Update, context: ContextTypes.D
                 #   这样，在规则执行期间，数据库查询将不会看到这条新的日志，从而得到正确的统计结果。
 
             # 如果是新群组，则植入默认规则并强制刷新缓存
+            # 注意：每个事件都要检查，不能按群组缓存“已检查”的结果——群组的规则可能被全部删除，
+            # 或者数据库被清空，此时需要重新植入默认规则。
             if _seed_rules_if_new_group(chat_id, db_session):
                 if chat_id in rule_cache:
                     del rule_cache[chat_id]
@@ -157,12 +184,13 @@ async def process_event(event_type: str, update: Update, context: ContextTypes.D
                 cached_rules = []
                 for db_rule in rules_from_db:
                     try:
-                        parsed_ast = RuleParser(db_rule.script).parse()
+                        # 通过 `parse_rule` 解析：脚本未改变的规则（包括所有群组共用的默认规则）
+                        # 在缓存失效后重新加载时可以直接复用之前的 AST。
+                        parsed_ast = parse_rule(db_rule.script)
                         cached_rules.append((db_rule.id, db_rule.name, parsed_ast))
                     except RuleParserError as e:
                         logger.error(f"解析规则ID {db_rule.id} ('{db_rule.name}') 失败: {e}")
                 rule_cache[chat_id] = cached_rules
-                context.bot_data['rule_cache'] = rule_cache
                 logger.info(f"已为群组 {chat_id} 缓存 {len(cached_rules)} 条已激活规则。")
 
             rules_to_process = rule_cache.get(chat_id, [])
@@ -170,12 +198,21 @@ async def process_event(event_type: str, update: Update, context: ContextTypes.D
                 return
 
             logger.debug(f"[{chat_id}] 正在处理事件 '{event_type}'，共有 {len(rules_to_process)} 条规则。")
+            # 代码评审意见:
+            # - [性能优化] 同一事件匹配的所有规则共用一个执行器，而不是为每条规则各创建一个。
+            #   执行器持有的 update、db_session 以及 `per_request_cache` 本就是按事件划分的，
+            #   共用后，命令解析、管理员身份查询等请求级缓存也能在同一事件的多条规则之间复用。
+            # - 执行器不能跨事件缓存（例如按群组缓存），因为它绑定了本次事件的 update 和数据库会话。
+            executor = None
             for rule_id, rule_name, parsed_rule in rules_to_process:
                 # 检查事件类型是否匹配
                 if parsed_rule.when_events and any(event_type.lower() == e.lower() for e in parsed_rule.when_events):
                     logger.debug(f"[{chat_id}] 事件 '{event_type}' 匹配规则 '{rule_name}' (ID: {rule_id})。正在执行...")
                     try:
-                        executor = RuleExecutor(update, context, db_session, rule_name=rule_name)
+                        if executor is None:
+                            executor = RuleExecutor(update, context, db_session, rule_name=rule_name)
+                        else:
+                            executor.rule_name = rule_name
                         await executor.execute_rule(parsed_rule)
                     except StopRuleProcessing:
                         logger.info(f"规则 '{rule_name}' 请求停止处理后续规则。")
@@ -448,8 +485,7 @@ async def verification_timeout_handler(context: ContextTypes.DEFAULT_TYPE):
         verification = db.query(Verification).filter_by(group_id=group_id, user_id=user_id).first()
         if verification:
             try:
-                await context.bot.ban_chat_member(chat_id=group_id, user_id=user_id)
-                await context.bot.unban_chat_member(chat_id=group_id, user_id=user_id)
+                await _kick_user(context, group_id, user_id)
                 await context.bot.send_message(chat_id=user_id, text=f"您在群组 (ID: {group_id}) 的验证已超时，已被移出群组。")
             except Exception as e:
                 logger.error(f"验证超时后踢出用户 {user_id} 时失败: {e}")
@@ -513,7 +549,10 @@ async def verification_callback_handler(update: Update, context: ContextTypes.DE
     await query.answer()
 
     try:
-        _, group_id_str, user_id_str, answer = query.data.split('_')
+        # 回调数据格式固定为 "verify_{group_id}_{user_id}_{answer}"，用 `str.split` 按分隔符拆分即可，无需正则。
+        prefix, group_id_str, user_id_str, answer = query.data.split('_', 3)
+        if prefix != 'verify':
+            raise ValueError(f"未知的回调数据前缀: {prefix}")
         group_id, user_id = int(group_id_str), int(user_id_str)
     except ValueError:
         return await query.edit_message_text(text="回调数据格式错误，请重试。")
@@ -534,9 +573,10 @@ async def verification_callback_handler(update: Update, context: ContextTypes.DE
         else:
             verification.attempts_made += 1
             if verification.attempts_made >= 3:
+                # 先编辑提示消息再踢人，两者保持顺序执行：如果编辑失败，异常会使事务回滚，
+                # 此时也不应该把用户踢出群组（否则用户已被踢出，验证记录却仍保留）。
                 await query.edit_message_text(text="❌ 验证失败次数过多，您已被移出群组。")
-                await context.bot.ban_chat_member(chat_id=group_id, user_id=user_id)
-                await context.bot.unban_chat_member(chat_id=group_id, user_id=user_id) # Kick
+                await _kick_user(context, group_id, user_id)
                 db.delete(verification)
             else:
                 # 生成新的验证码并更新消息
@@ -441,7 +441,7 @@ class RuleExecutor:
         # - 这里的逻辑非常健壮。特别是对 `+` 运算符的处理，它能正确地根据操作数的类型（列表、字符串、数字）
         #   执行拼接或相加，并且对 `null` 值有合理的默认行为（视作 0 或空字符串），这大大增强了语言的易用性。
         # - 对 `and` 和 `or` 的短路求值（short-circuit evaluation）实现是正确的，这对于性能和逻辑正确性都至关重要。
-        op = expr.op.lower()
+        op = expr.op  # `BinaryOp` 在构造时已将运算符规范为小写
 
         if op == 'and':
             left_val = await self._evaluate_expression(expr.left, current_scope)
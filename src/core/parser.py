@@ -2,7 +2,7 @@
 
 import re
 import ast
-import warnings
+import functools
 from dataclasses import dataclass, field
 from typing import List, Any, Optional, Dict
 
@@ -48,98 +48,109 @@ class RuleParserError(Exception):
 # - 使用 `dataclass` 来定义 AST 节点是一个极佳的选择。它减少了大量样板代码（如 __init__），
 #   使得节点的结构一目了然，非常清晰。
 # - AST 节点的命名和结构划分（表达式、语句、顶层规则）都非常合理，覆盖了语言的所有语法特性。
+# - [性能优化] 所有节点都声明为 `frozen=True, slots=True`：实例没有 `__dict__`，内存占用更小、属性读取更快；
+#   同时，经 `parse_rule` 缓存并在多次执行之间共享的 AST 也因此无法被意外修改。
+#   注意：冻结只约束字段的绑定，`StatementBlock.statements` 等容器字段本身仍是普通的 list/dict。
 
 # --- 表达式节点 (Expression Nodes) ---
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Expr:
     """所有表达式节点的基类。"""
     pass
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Literal(Expr):
     """字面量节点，例如: "hello", 123, true"""
     value: Any
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ListConstructor(Expr):
     """列表构造节点，例如: [1, "a", my_var]"""
     elements: List[Expr]
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class DictConstructor(Expr):
     """字典构造节点，例如: {"key": my_var}"""
     pairs: Dict[str, Expr]
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Variable(Expr):
     """变量访问节点，例如: my_var"""
     name: str
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class PropertyAccess(Expr):
     """属性访问节点，例如: my_obj.property"""
     target: Expr
     property: str
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class IndexAccess(Expr):
     """下标访问节点，例如: my_list[0]"""
     target: Expr
     index: Expr
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class BinaryOp(Expr):
     """二元运算节点，例如: x + y"""
     left: Expr
     op: str
     right: Expr
 
-@dataclass
+    def __post_init__(self):
+        # 执行器直接按小写比较运算符 (不再在每次求值时调用 `.lower()`)。
+        # 分词器已将运算符转为小写，这里在构造时再规范一次，
+        # 保证手工构造的节点 (例如 `BinaryOp(a, 'AND', b)`) 也能被正确求值。
+        lowered = self.op.lower()
+        if lowered != self.op:
+            object.__setattr__(self, 'op', lowered)
+
+@dataclass(frozen=True, slots=True)
 class ActionCallExpr(Expr):
     """动作/函数调用表达式节点，例如: len(my_list)"""
     action_name: str
     args: List[Expr]
 
 # --- 语句节点 (Statement Nodes) ---
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Stmt:
     """所有语句节点的基类。"""
     pass
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Assignment(Expr): # 在我们的语言中，赋值既是语句也是表达式（例如 `a = b = 5;`），因此它继承自 Expr。
     """赋值表达式节点，例如: x = 10"""
     variable: Expr  # 左值（L-value）可以是变量、属性访问或下标访问，代表要被赋值的目标。
     expression: Expr
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ActionCallStmt(Stmt):
     """动作调用语句节点，例如: reply("hello");"""
     call: ActionCallExpr
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class StatementBlock(Stmt):
     """语句块节点，例如: { ... }"""
     statements: List[Stmt] = field(default_factory=list)
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ForEachStmt(Stmt):
     """foreach 循环语句节点"""
     loop_var: str
     collection: Expr
     body: StatementBlock
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class BreakStmt(Stmt):
     """break 语句节点"""
     pass
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ContinueStmt(Stmt):
     """continue 语句节点"""
     pass
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class IfStmt(Stmt):
     """if/else 语句节点"""
     condition: Expr
@@ -148,7 +159,7 @@ class IfStmt(Stmt):
 
 
 # --- 顶层规则结构 ---
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ParsedRule:
     """
     代表一个完全解析后的规则的顶层AST节点。
@@ -218,19 +229,60 @@ def tokenize(code: str) -> List[Token]:
             continue
         elif kind == 'MISMATCH':
             raise RuleParserError(f"存在无效字符: {value}", line_num, column)
+        elif kind == 'COMPARE_OP' or kind == 'LOGIC_OP':
+            # [性能优化] 运算符不区分大小写，在分词时统一规范为小写，
+            # 这样 AST 中的 `BinaryOp.op` 总是小写形式，下游（优先级查表、执行器）无需再逐次调用 .lower()。
+            value = value.lower()
         tokens.append(Token(kind, value, line_num, column))
     return tokens
 
 
+# 字符串字面量中的转义序列：按从左到右、互不重叠的方式匹配 `\x` 对，因此 `\\z` 会被正确地视为
+# 一个转义的反斜杠加上普通字符 `z`，而不是无效转义 `\z`。
+STRING_ESCAPE_REGEX = re.compile(r'\\(.)', flags=re.DOTALL)
+# Python 字符串字面量所支持的转义字符（反斜杠之后的第一个字符）
+VALID_ESCAPE_CHARS = frozenset('\n\\\'"abfnrtv01234567xNuU')
+
+def decode_string_literal(literal: str) -> str:
+    r"""
+    将一个 STRING token（包含两侧引号）解码为 Python 字符串。
+
+    - 不含反斜杠及特殊控制字符的字面量（绝大多数情况）直接去掉引号返回，不经过 `ast.literal_eval`。
+    - 其余情况先用预编译的正则检查转义序列，遇到无效转义（如 `\z`）立即抛出 `ValueError`，
+      然后交给 `ast.literal_eval` 处理合法的转义（`\n`、`\u4f60` 等）。
+      此前的做法是依赖 `literal_eval` 发出的 SyntaxWarning，但在 Python 3.11 及更早版本中
+      无效转义只会发出 DeprecationWarning，`\z` 因而被静默接受；且每次解码都要进入 `warnings.catch_warnings()`。
+    """
+    body = literal[1:-1]
+    if '\\' not in body and '\n' not in body and '\r' not in body and '\0' not in body:
+        return body
+    for mo in STRING_ESCAPE_REGEX.finditer(body):
+        if mo.group(1) not in VALID_ESCAPE_CHARS:
+            raise ValueError(f"无效的转义序列 '\\{mo.group(1)}'")
+    return ast.literal_eval(literal)
+
+
 # =================== 规则解析器 ===================
 
+# 二元运算符优先级表（数值越大，结合越紧密），供 Pratt 解析中的 `_get_operator_precedence` 查表使用。
+# [性能优化] 以一次字典查找代替按 token 类型逐级判断的 if 链；键为运算符文本（分词器已将其规范为小写）。
+OPERATOR_PRECEDENCE = {
+    '=': 1,
+    'or': 2,
+    'and': 3, 'not': 3,
+    '==': 4, '!=': 4, '>=': 4, '<=': 4, '>': 4, '<': 4,
+    'contains': 4, 'startswith': 4, 'endswith': 4,
+    '+': 5, '-': 5,
+    '*': 6, '/': 6,
+}
+
+
 class RuleParser:
     def __init__(self, script: str):
         self.tokens: List[Token] = tokenize(script)
         self.pos: int = 0
 
     def parse(self) -> ParsedRule:
-        rule = ParsedRule()
         self._consume_keyword('WHEN')
 
         events = []
@@ -257,18 +309,19 @@ class RuleParser:
                 continue
             else:
                 break
-        rule.when_events = events
 
+        where_clause = None
         if self._peek_value('WHERE'):
             self._consume_keyword('WHERE')
-            rule.where_clause = self._parse_expression()
+            where_clause = self._parse_expression()
 
         self._consume_keyword('THEN')
-        rule.then_block = self._parse_statement_block()
+        then_block = self._parse_statement_block()
 
         if not self._is_at_end() and self._peek_value('END'):
             self._consume_keyword('END')
-        return rule
+        # ParsedRule 是不可变的，因此在收集完所有子句后一次性构造
+        return ParsedRule(when_events=events, where_clause=where_clause, then_block=then_block)
 
     def _parse_statement_block(self) -> StatementBlock:
         statements = []
@@ -361,15 +414,10 @@ class RuleParser:
         return lhs
 
     def _get_operator_precedence(self, token: Token) -> int:
-        op = token.value.lower()
-        if token.type == 'EQUALS': return 1
-        if token.type == 'LOGIC_OP': return 2 if op == 'or' else 3
-        if token.type == 'COMPARE_OP': return 4
-        if token.type == 'ARITH_OP': return 5 if op in ('+', '-') else 6
-        return 0
+        return OPERATOR_PRECEDENCE.get(token.value, 0)
 
     def _parse_unary_expression(self) -> Expr:
-        if self._peek_type('LOGIC_OP') and self._current_token().value.lower() == 'not':
+        if self._peek_type('LOGIC_OP') and self._current_token().value == 'not':
             op_token = self._consume_keyword('not')
             operand = self._parse_unary_expression()
             # 代码评审意见:
@@ -400,14 +448,10 @@ class RuleParser:
         token = self._current_token()
         if token.type == 'STRING':
             self._consume('STRING')
-            # 使用 ast.literal_eval 并将 SyntaxWarning 提升为错误，以严格处理无效转义序列。
-            with warnings.catch_warnings():
-                warnings.simplefilter("error", SyntaxWarning)
-                try:
-                    unescaped_string = ast.literal_eval(token.value)
-                    return Literal(value=unescaped_string)
-                except (ValueError, SyntaxError) as e:
-                    raise RuleParserError(f"字符串字面量无效: {e}", token.line, token.column)
+            try:
+                return Literal(value=decode_string_literal(token.value))
+            except (ValueError, SyntaxError) as e:
+                raise RuleParserError(f"字符串字面量无效: {e}", token.line, token.column)
         elif token.type == 'NUMBER':
             self._consume('NUMBER')
             return Literal(value=float(token.value) if '.' in token.value else int(token.value))
@@ -453,12 +497,10 @@ class RuleParser:
         if not self._peek_type('RBRACE'):
             while True:
                 key_token = self._consume('STRING')
-                with warnings.catch_warnings():
-                    warnings.simplefilter("error", SyntaxWarning)
-                    try:
-                        key = ast.literal_eval(key_token.value)
-                    except (ValueError, SyntaxError) as e:
-                        raise RuleParserError(f"字典键字符串字面量无效: {e}", key_token.line, key_token.column)
+                try:
+                    key = decode_string_literal(key_token.value)
+                except (ValueError, SyntaxError) as e:
+                    raise RuleParserError(f"字典键字符串字面量无效: {e}", key_token.line, key_token.column)
 
                 self._consume('COLON')
                 value = self._parse_expression()
@@ -509,6 +551,20 @@ class RuleParser:
     def _is_at_end(self) -> bool:
         return self.pos >= len(self.tokens)
 
+@functools.lru_cache(maxsize=4096)
+def parse_rule(script: str) -> ParsedRule:
+    """
+    解析一条规则脚本，并按脚本文本在进程范围内缓存解析结果 (AST)。
+
+    代码评审意见:
+    - `RuleParser` 是一次性的有状态对象（持有 token 列表和当前位置），无法作为单例复用；
+      真正可复用的是解析结果。分词所用的正则 `TOKEN_REGEX` 已在模块导入时编译过一次。
+    - 对同一脚本的重复解析（规则缓存失效后重新加载、启动时加载计划任务、语法预检等）
+      都会直接命中缓存。AST 在执行期间是只读的，因此可以安全地共享。
+    - 解析失败时抛出的 `RuleParserError` 不会被缓存。
+    """
+    return RuleParser(script).parse()
+
 def precompile_rule(script: str) -> (bool, Optional[str]):
     # 代码评审意见:
     # - 这是一个非常有价值的工具函数。它将解析器的核心功能暴露出来，
@@ -518,7 +574,7 @@ def precompile_rule(script: str) -> (bool, Optional[str]):
     if not isinstance(script, str) or not script.strip():
         return False, "脚本不能为空。"
     try:
-        RuleParser(script).parse()
+        parse_rule(script)
         return True, None
     except RuleParserError as e:
         return False, str(e)
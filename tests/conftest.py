@@ -1,51 +1,186 @@
 # tests/conftest.py
 
+import importlib
 import pytest
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from unittest.mock import MagicMock, AsyncMock
 
-from sqlalchemy import create_engine
+from telegram import Bot
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 
+import src.bot.handlers as handlers
 from src.database import Base, User, Group
 from src.utils import session_scope
 
-@pytest.fixture(scope="function")
-def test_db_session_factory():
+try:
+    import uvloop
+except ImportError:  # uvloop 是可选的测试加速依赖，未安装时回退到标准 asyncio 循环
+    uvloop = None
+
+
+if uvloop is not None:
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_asyncio_loop_factories(config, item):
+        """
+        性能优化: 如果安装了 uvloop，则让 pytest-asyncio 使用 uvloop 创建事件循环。
+        配合 pytest.ini 中的会话级循环作用域，整个测试会话只创建一次事件循环。
+        """
+        return {"uvloop": uvloop.new_event_loop}
+
+
+@pytest.fixture(scope="session")
+def test_db_engine():
     """
-    提供一个基于内存的、干净的 SQLite 数据库会话工厂。
-    'function' 作用域确保每个测试函数都获得一个全新的数据库。
+    提供一个在整个测试会话中共享的内存 SQLite 引擎，表结构只创建一次。
+    由于数据库位于进程内存中，使用 `pytest -n auto` (pytest-xdist) 并行运行时，
+    每个 worker 进程天然拥有互相隔离的数据库，无需额外的按 worker 划分的数据库文件。
     """
     # 关键修复：为内存中的 SQLite 添加 check_same_thread=False。
     # 这是因为 pytest-asyncio 可能会在不同的线程中运行测试和事件循环，
     # 如果不设置此项，当从另一个线程访问数据库连接时，程序可能会挂起。
-    engine = create_engine("sqlite:///:memory:", connect_args={"check_same_thread": False})
+    # 性能优化: 使用 StaticPool，使所有会话共享同一个底层连接（即同一个内存数据库），
+    # 避免为不同线程建立新连接时得到一个空的内存数据库。
+    # 性能优化: 显式设置编译缓存容量 (query_cache_size)。测试中反复执行的同形状语句
+    # 只在第一次执行时编译 SQL，之后直接命中引擎的编译缓存。
+    engine = create_engine(
+        "sqlite:///:memory:",
+        poolclass=StaticPool,
+        connect_args={"check_same_thread": False},
+        query_cache_size=1200,
+    )
+
+    # 性能优化: 测试数据库无需持久化保证，关闭同步写入并将日志/临时数据保存在内存中，
+    # 以降低频繁提交（commit）的测试的开销。仅用于测试引擎。
+    @event.listens_for(engine, "connect")
+    def _fast_sqlite(dbapi_conn, _):
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA synchronous=OFF")
+        cursor.execute("PRAGMA journal_mode=MEMORY")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
     Base.metadata.create_all(engine)
-    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    yield engine
+    # 内存数据库随唯一的连接一起销毁，无需再逐表执行 DROP TABLE。
+    engine.dispose()
+
+@pytest.fixture(scope="session")
+def main_module():
+    """
+    提供机器人入口模块 `main`。
+    该模块在整个测试会话中只导入一次；测试通过这个 fixture 获取它，而不是各自在模块顶层导入。
+    `@patch('main.xxx')` 修补的正是这个模块对象上的属性。
+    """
+    return importlib.import_module("main")
+
+@pytest.fixture(scope="function")
+def test_db_session_factory(test_db_engine):
+    """
+    提供一个基于内存的、干净的 SQLite 数据库会话工厂。
+    性能优化: 表结构由会话级的 `test_db_engine` 只创建一次；每个测试结束后清空所有表中的数据，
+    确保每个测试函数都从一个空数据库开始，而无需为每个测试重复执行 CREATE/DROP TABLE。
+    (被测代码通过 `session_scope` 自行提交事务，且同一测试中可能有多个会话并发使用同一连接，
+    因此这里采用清空数据而不是外层事务 + SAVEPOINT 回滚的方式来隔离测试。)
+    """
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=test_db_engine)
     yield factory
-    Base.metadata.drop_all(engine)
+    with test_db_engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+
+@pytest.fixture
+def count_queries(test_db_engine):
+    """
+    提供一个上下文管理器，记录其作用域内测试引擎执行的所有 SQL 语句。
+    用于断言被测代码的查询次数上限，防止 N+1 查询（例如每条规则一次 SELECT）悄悄回归。
+
+    用法:
+        with count_queries() as statements:
+            await process_event(...)
+        assert len(statements) <= 5
+    """
+    @contextmanager
+    def _count_queries():
+        statements = []
+
+        def _record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(test_db_engine, "before_cursor_execute", _record)
+        try:
+            yield statements
+        finally:
+            event.remove(test_db_engine, "before_cursor_execute", _record)
+
+    return _count_queries
+
+@pytest.fixture
+def frozen_now(monkeypatch):
+    """
+    冻结规则引擎变量解析器 (`src.core.resolver`) 看到的当前时间，并返回这个时间点。
+    测试可以据此构造相对于同一个 "now" 的事件日志，统计窗口 (1h/24h/1d) 的边界因此是确定的，
+    不会随测试执行耗时漂移。
+    冻结点取测试开始时的真实时间，而不是一个固定日期：被测代码写入的事件日志仍使用数据库默认的真实时间戳，
+    它们只会落在冻结点之后，与冻结前的行为一致。
+    """
+    now = datetime.now(timezone.utc)
+
+    class _FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now.astimezone(tz) if tz is not None else now.replace(tzinfo=None)
+
+    monkeypatch.setattr("src.core.resolver.datetime", _FrozenDatetime)
+    return now
+
+@pytest.fixture(autouse=True)
+def _no_seed(request):
+    """
+    对带有 `@pytest.mark.no_seed` 标记的测试，关闭 `_seed_rules_if_new_group` 的默认规则植入。
+    相比在每个测试中 `patch` 该函数，只需切换一个模块级开关，测试结束后自动恢复。
+    """
+    if request.node.get_closest_marker("no_seed") is None:
+        yield
+        return
+    handlers._SEED_DISABLED = True
+    try:
+        yield
+    finally:
+        handlers._SEED_DISABLED = False
 
 @pytest.fixture
 def mock_context(test_db_session_factory):
     """
     提供一个模拟的 Telegram Context 对象。
     这个 context 被预先填充了测试所需的关键对象，如数据库会话工厂和模拟的 bot 对象。
+    注意: 整个测试会话共享同一个事件循环（见 pytest.ini），但 bot、job_queue 以及 context 本身
+    都是 'function' 作用域，每个测试都会重新构建：测试可以自由地设置属性
+    （例如 `bot.username`）或替换子 mock（例如 `bot.get_chat_member`），而不会泄漏到其他测试。
+    bot 使用 `spec=Bot`：只允许访问真实 `telegram.Bot` 上存在的属性，拼错的方法名会立即报错，
+    而不是悄悄生成一个新的子 mock。
     """
+    bot = MagicMock(spec=Bot)
+    bot.send_message = AsyncMock()
+    bot.restrict_chat_member = AsyncMock()
+    bot.ban_chat_member = AsyncMock()
+    bot.unban_chat_member = AsyncMock()
+    # 修复记录 (2025-08-14): 添加了 answer_callback_query 作为 AsyncMock。
+    # 此前，当测试调用此方法时，MagicMock 会动态创建一个同步的 mock，
+    # 这导致了在 'await' 表达式中使用它时出现 TypeError。
+    # 将其明确声明为 AsyncMock 确保了它能被正确地 'await'。
+    bot.answer_callback_query = AsyncMock()
+    bot.send_photo = AsyncMock()
+    bot.get_chat = AsyncMock()
+
     context = MagicMock()
     # 修复：确保 bot_data 总是被初始化为一个字典
     context.bot_data = {}
     context.bot_data['rule_cache'] = {}
     context.bot_data['session_factory'] = test_db_session_factory
-    context.bot = MagicMock()
-    context.bot.send_message = AsyncMock()
-    context.bot.restrict_chat_member = AsyncMock()
-    context.bot.ban_chat_member = AsyncMock()
-    context.bot.unban_chat_member = AsyncMock()
-    # 修复记录 (2025-08-14): 添加了 answer_callback_query 作为 AsyncMock。
-    # 此前，当测试调用此方法时，MagicMock 会动态创建一个同步的 mock，
-    # 这导致了在 'await' 表达式中使用它时出现 TypeError。
-    # 将其明确声明为 AsyncMock 确保了它能被正确地 'await'。
-    context.bot.answer_callback_query = AsyncMock()
-    context.bot.send_photo = AsyncMock()
+    context.bot = bot
     context.job_queue = MagicMock()
     context.job_queue.run_once = MagicMock()
     return context
@@ -88,6 +223,7 @@ def mock_update():
     update.callback_query = MagicMock()
     update.callback_query.answer = AsyncMock()
     update.callback_query.edit_message_text = AsyncMock()
+    update.callback_query.edit_message_media = AsyncMock()
     return update
 
 @pytest.fixture(scope="function")
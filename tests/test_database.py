@@ -1,32 +1,22 @@
 # tests/test_database.py
 import pytest
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import IntegrityError
 
 # 从重构后的 database 模块导入所有需要的组件
-from src.database import Base, Group, Rule, StateVariable, Log, User, Verification, EventLog
-
-# 使用内存中的 SQLite 数据库进行测试，这样可以保证每次测试都在一个干净、隔离的环境中运行。
-TEST_DATABASE_URL = "sqlite:///:memory:"
+from src.database import Group, Rule, StateVariable, Log, User, Verification, EventLog
 
 @pytest.fixture(scope="function")
-def session():
+def session(test_db_session_factory):
     """
-    Pytest Fixture: 为每个测试函数创建一个独立的、干净的数据库会话。
+    Pytest Fixture: 为每个测试函数提供一个独立的数据库会话。
 
-    `scope="function"` (默认作用域) 是这里的关键。它确保：
-    1. 在每个测试函数开始前，所有表都会被创建。
-    2. 在每个测试函数结束后，所有表都会被删除 (`drop_all`)。
-    这可以完美地隔离每个测试，防止一个测试的数据库状态泄露到另一个测试中。
+    数据库引擎和表结构由 conftest 中的会话级 `test_db_engine` 只创建一次；
+    每个测试结束后，`test_db_session_factory` 会清空所有表中的数据，
+    从而在不重复执行 `create_all`/`drop_all` 的情况下隔离每个测试。
     """
-    engine = create_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False})
-    Base.metadata.create_all(engine)
-    SessionFactory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    db_session = SessionFactory()
+    db_session = test_db_session_factory()
     yield db_session
     db_session.close()
-    Base.metadata.drop_all(engine)
 
 
 @pytest.mark.asyncio
@@ -236,6 +226,17 @@ def test_init_database_with_malformed_url(caplog):
     assert "类型:" not in caplog.text # 确认没有打印出类型
 
 
+def test_init_database_creates_rule_lookup_index():
+    """测试 init_database 会为规则表创建 (group_id, is_active, priority) 复合索引。"""
+    from src.database import init_database
+    from sqlalchemy import inspect
+    engine = init_database("sqlite:///:memory:")
+    indexes = {ix['name']: ix['column_names'] for ix in inspect(engine).get_indexes('rules')}
+    assert indexes['ix_rule_group_active_prio'] == ['group_id', 'is_active', 'priority']
+    # 复合索引以 group_id 开头，不应再有多余的单列 group_id 索引
+    assert ['group_id'] not in indexes.values()
+
+
 def test_set_state_variable_deletion(session):
     """测试 set_state_variable_in_db 函数能否正确删除一个已存在的变量。"""
     from src.database import set_state_variable_in_db
@@ -4,7 +4,7 @@ import pytest
 from unittest.mock import Mock, AsyncMock, patch
 from telegram import ChatPermissions
 
-from src.core.parser import RuleParser
+from src.core.parser import RuleParser, BinaryOp, Literal
 from src.core.executor import RuleExecutor, _ACTION_REGISTRY
 from src.database import Log, StateVariable
 
@@ -131,6 +131,23 @@ async def test_list_and_dict_construction():
     assert result_dict == {'a': 10, 'b': 'hello', 'c': 99}
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("op, left, right, expected", [
+    ("AND", True, False, False),
+    ("Or", False, True, True),
+    ("CONTAINS", "hello world", "world", True),
+])
+async def test_hand_built_binary_op_is_normalized(op, left, right, expected):
+    """测试：手工构造的 `BinaryOp` 即使使用大写运算符，也会被规范为小写并正确求值。"""
+    expr = BinaryOp(Literal(left), op, Literal(right))
+    assert expr.op == op.lower()
+
+    mock_context = Mock()
+    mock_context.bot_data = {}
+    executor = RuleExecutor(Mock(), mock_context, Mock())
+    assert await executor._evaluate_expression(expr, {}) is expected
+
+
 @pytest.mark.asyncio
 async def test_action_ban_user(mock_update, mock_context):
     """测试 ban_user 动作。"""
@@ -271,9 +288,9 @@ async def test_expression_evaluation_edge_cases(expr, scope, expected):
 async def test_action_reply_with_parse_mode(mock_update, mock_context):
     """测试 reply 动作的 parse_mode 参数。"""
     # 1. 测试 reply(text, "HTML")
-    mock_update.effective_message.reply_text = AsyncMock()
+    # (reply_text 已由 conftest 中的 mock_update 预置为 AsyncMock)
     await _execute_then_block("reply('<b>bold</b>', 'HTML');", mock_update, mock_context)
-    mock_update.effective_message.reply_text.assert_called_once_with('<b>bold</b>', parse_mode='HTML')
+    mock_update.effective_message.reply_text.assert_awaited_once_with('<b>bold</b>', parse_mode='HTML')
 
     # 2. 测试不带 parse_mode 的普通 reply
     mock_update.effective_message.reply_text.reset_mock()
@@ -511,29 +528,46 @@ async def test_foreach_on_empty_and_null():
     assert final_scope_null['counter'] == 0
 
 
+def _if_elif_else_script(value: int) -> str:
+    """构造 if-elif-else 测试脚本，`x` 的赋值写在脚本内部，以覆盖赋值语句的执行路径。"""
+    return f"""
+    WHEN command THEN {{
+        x = {value};
+        result = "unknown";
+        if (x < 10) {{
+            result = "low";
+        }} else if (x < 20) {{
+            result = "medium";
+        }} else {{
+            result = "high";
+        }}
+        reply(result);
+    }}
+    END
+    """
+
+@pytest.fixture(scope="module")
+def if_elif_else_rule(request):
+    """
+    性能优化: 通过 `indirect` 参数化，按 `x` 的取值在模块作用域内缓存解析结果，
+    同一取值的脚本只解析一次（执行器不会修改 AST）。
+    """
+    return RuleParser(_if_elif_else_script(request.param)).parse()
+
 @pytest.mark.asyncio
-@pytest.mark.parametrize("value, expected_reply", [
+@pytest.mark.parametrize("if_elif_else_rule, expected_reply", [
     (5, "low"),
     (15, "medium"),
     (25, "high"),
-])
-async def test_if_elif_else_chain(value, expected_reply):
+], indirect=["if_elif_else_rule"])
+async def test_if_elif_else_chain(if_elif_else_rule, expected_reply):
     """测试 if-elif-else 逻辑链是否能正确执行。"""
-    script = f"""
-    x = {value};
-    result = "unknown";
-    if (x < 10) {{
-        result = "low";
-    }} else if (x < 20) {{
-        result = "medium";
-    }} else {{
-        result = "high";
-    }}
-    reply(result);
-    """
     mock_update = Mock()
     mock_update.effective_message.reply_text = AsyncMock()
-    await _execute_then_block(script, mock_update, Mock())
+    mock_context = Mock()
+    mock_context.bot_data = {}
+    executor = RuleExecutor(mock_update, mock_context, Mock())
+    await executor.execute_rule(if_elif_else_rule)
     mock_update.effective_message.reply_text.assert_called_once_with(expected_reply)
 
 
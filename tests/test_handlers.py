@@ -3,25 +3,24 @@
 import pytest
 import logging
 from unittest.mock import MagicMock, AsyncMock, patch
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, insert
 from sqlalchemy.orm import sessionmaker
+from cachetools import LRUCache
 
-from telegram import User
 from telegram.error import TelegramError
-from telegram.ext import ContextTypes
 
 from src.bot.handlers import (
     reload_rules_handler, process_event, rules_handler,
     rule_on_off_handler, verification_timeout_handler,
     media_message_handler, _process_aggregated_media_group, rule_help_handler,
     start_handler, verification_callback_handler, _is_user_admin, _seed_rules_if_new_group, user_join_handler,
-    _get_rule_from_command
+    _get_rule_from_command, RULE_CACHE_MAXSIZE
 )
+from src.bot.default_rules import DEFAULT_RULES
+from src.core.parser import parse_rule
 from src.database import Base, Rule, Group, Log, Verification
 from src.utils import session_scope
 
-pytestmark = pytest.mark.asyncio # [Refactor] 移除模块级标记
-
 
 @pytest.mark.asyncio
 async def test_reload_rules_by_admin(mock_update, mock_context):
@@ -147,7 +146,7 @@ async def test_verification_timeout_handler(mock_context, test_db_session_factor
     group_id = -1001
     user_id = 123
     with session_scope(test_db_session_factory) as db:
-        db.add(Verification(group_id=group_id, user_id=user_id, correct_answer="123"))
+        db.execute(insert(Verification), [dict(group_id=group_id, user_id=user_id, correct_answer="123")])
 
     # 模拟 Job context
     mock_job = MagicMock()
@@ -192,7 +191,6 @@ async def test_process_event_caching_logic(MockRuleExecutor, mock_update, mock_c
     assert "缓存未命中" in caplog.text
     assert -1001 in mock_context.bot_data['rule_cache']
     # The number of loaded rules should match the number of default rules.
-    from src.bot.default_rules import DEFAULT_RULES
     assert len(mock_context.bot_data['rule_cache'][-1001]) == len(DEFAULT_RULES)
     # The executor should have been called at least once.
     assert MockRuleExecutor.called
@@ -214,6 +212,69 @@ async def test_process_event_caching_logic(MockRuleExecutor, mock_update, mock_c
     assert MockRuleExecutor.called
 
 
+@pytest.mark.asyncio
+@patch('src.bot.handlers.RuleExecutor')
+async def test_process_event_shares_executor_across_matching_rules(MockRuleExecutor, mock_update, mock_context, test_db_session_factory):
+    """
+    测试：同一事件匹配的多条规则共用一个执行器实例，并依次更新其规则名称。
+    """
+    # --- 准备 ---
+    mock_executor_instance = MockRuleExecutor.return_value
+    mock_executor_instance.execute_rule = AsyncMock()
+    with session_scope(test_db_session_factory) as db:
+        db.add(Group(id=-1001, name="Test Group"))
+        db.add(Rule(group_id=-1001, name="Rule A", script="WHEN message THEN {} END", priority=2))
+        db.add(Rule(group_id=-1001, name="Rule B", script="WHEN message THEN {} END", priority=1))
+        db.add(Rule(group_id=-1001, name="Rule C", script="WHEN command THEN {} END", priority=0))
+
+    # --- 执行 ---
+    await process_event("message", mock_update, mock_context)
+
+    # --- 验证 ---
+    assert MockRuleExecutor.call_count == 1
+    assert MockRuleExecutor.call_args.kwargs['rule_name'] == "Rule A"
+    assert mock_executor_instance.execute_rule.await_count == 2
+    assert mock_executor_instance.rule_name == "Rule B"
+
+
+@pytest.mark.asyncio
+@patch('src.bot.handlers.RuleExecutor')
+async def test_process_event_rule_cache_is_bounded_lru(MockRuleExecutor, mock_update, mock_context):
+    """
+    测试：当 bot_data 中没有规则缓存时，process_event 会创建一个有容量上限的 LRUCache。
+    """
+    MockRuleExecutor.return_value.execute_rule = AsyncMock()
+    del mock_context.bot_data['rule_cache']
+
+    await process_event("message", mock_update, mock_context)
+
+    rule_cache = mock_context.bot_data['rule_cache']
+    assert isinstance(rule_cache, LRUCache)
+    assert rule_cache.maxsize == RULE_CACHE_MAXSIZE
+    assert -1001 in rule_cache
+
+
+@pytest.mark.asyncio
+@patch('src.bot.handlers.RuleExecutor')
+async def test_process_event_reseeds_after_rules_cleared(MockRuleExecutor, mock_update, mock_context, test_db_session_factory):
+    """
+    测试：群组的规则在进程运行期间被全部删除（或数据库被清空）后，
+    下一个事件会重新植入默认规则，并刷新该群组的规则缓存。
+    """
+    MockRuleExecutor.return_value.execute_rule = AsyncMock()
+
+    await process_event("message", mock_update, mock_context)
+    with session_scope(test_db_session_factory) as db:
+        assert db.query(Rule).filter_by(group_id=-1001).count() == len(DEFAULT_RULES)
+        db.query(Rule).filter_by(group_id=-1001).delete()
+
+    await process_event("message", mock_update, mock_context)
+
+    with session_scope(test_db_session_factory) as db:
+        assert db.query(Rule).filter_by(group_id=-1001).count() == len(DEFAULT_RULES)
+    assert len(mock_context.bot_data['rule_cache'][-1001]) == len(DEFAULT_RULES)
+
+
 @pytest.mark.asyncio
 @patch('src.bot.handlers.RuleExecutor')
 async def test_seed_rules_for_new_group(MockRuleExecutor, mock_update, mock_context, test_db_session_factory):
@@ -226,7 +287,6 @@ async def test_seed_rules_for_new_group(MockRuleExecutor, mock_update, mock_cont
         assert db.query(Group).count() == 0
         assert db.query(Rule).count() == 0
 
-    from src.bot.default_rules import DEFAULT_RULES
     mock_executor_instance = MockRuleExecutor.return_value
     mock_executor_instance.execute_rule = AsyncMock()
 
@@ -260,7 +320,6 @@ async def test_seed_rules_is_robust_to_empty_rules(MockRuleExecutor, mock_update
         assert db.query(Group).count() == 1
         assert db.query(Rule).count() == 0
 
-    from src.bot.default_rules import DEFAULT_RULES
     mock_executor_instance = MockRuleExecutor.return_value
     mock_executor_instance.execute_rule = AsyncMock()
 
@@ -507,8 +566,6 @@ async def test_verification_callback_no_record(mock_update, mock_context, test_d
 
     mock_update.callback_query.data = "verify_-1001_123_42"
     mock_update.callback_query.from_user.id = 123
-    mock_update.callback_query.answer = AsyncMock()
-    mock_update.callback_query.edit_message_text = AsyncMock()
 
     # --- 执行 ---
     await verification_callback_handler(mock_update, mock_context)
@@ -532,8 +589,6 @@ async def test_verification_callback_wrong_answer_retries(mock_generate_math_ima
 
     mock_update.callback_query.data = f"verify_{group_id}_{user_id}_99" # 错误答案
     mock_update.callback_query.from_user.id = user_id
-    mock_update.callback_query.answer = AsyncMock()
-    mock_update.callback_query.edit_message_media = AsyncMock()
 
     # --- 执行 ---
     await verification_callback_handler(mock_update, mock_context)
@@ -564,8 +619,6 @@ async def test_verification_callback_correct_answer(mock_unmute_util, mock_updat
 
     mock_update.callback_query.data = f"verify_{group_id}_{user_id}_{correct_answer}" # 正确答案
     mock_update.callback_query.from_user.id = user_id
-    mock_update.callback_query.answer = AsyncMock()
-    mock_update.callback_query.edit_message_text = AsyncMock()
 
     # --- 执行 ---
     await verification_callback_handler(mock_update, mock_context)
@@ -663,6 +716,58 @@ async def test_process_event_cache_invalidation(MockRuleExecutor, mock_update, m
     MockRuleExecutor.assert_called()
 
 
+@pytest.mark.asyncio
+@patch('src.bot.handlers.RuleExecutor')
+async def test_process_event_reuses_parsed_ast_after_invalidation(MockRuleExecutor, mock_update, mock_context, test_db_session_factory):
+    """
+    测试：规则缓存失效后再次未命中时，脚本未改变的规则不会被重新解析。
+    """
+    # --- 1. 准备 ---
+    MockRuleExecutor.return_value.execute_rule = AsyncMock()
+    group_id = mock_update.effective_chat.id
+    with session_scope(test_db_session_factory) as db:
+        db.add(Group(id=group_id, name="Test Group"))
+        db.add(Rule(group_id=group_id, name="Test Rule", script="WHEN message THEN { reply('ast'); } END", is_active=True))
+    parse_rule.cache_clear()
+
+    # --- 2. 第一次调用会解析脚本 ---
+    await process_event("message", mock_update, mock_context)
+    first_ast = mock_context.bot_data['rule_cache'][group_id][0][2]
+
+    # --- 3. 使缓存失效后再次调用 ---
+    del mock_context.bot_data['rule_cache'][group_id]
+    with patch('src.core.parser.RuleParser') as MockRuleParser:
+        await process_event("message", mock_update, mock_context)
+
+    # --- 4. 验证: 没有重新解析，且复用了同一个 AST 对象 ---
+    MockRuleParser.assert_not_called()
+    assert mock_context.bot_data['rule_cache'][group_id][0][2] is first_ast
+
+
+@pytest.mark.asyncio
+@patch('src.bot.handlers.RuleExecutor')
+async def test_process_event_default_rules_parsed_once_across_groups(MockRuleExecutor, mock_update, mock_context):
+    """
+    测试：不同群组植入的默认规则脚本完全相同，因此每条默认规则在整个进程中只被解析一次，
+    且各群组的规则缓存共享同一批 AST 对象。
+    """
+    MockRuleExecutor.return_value.execute_rule = AsyncMock()
+    parse_rule.cache_clear()
+
+    other_update = MagicMock()
+    other_update.effective_chat.id = -1002
+    other_update.effective_user = mock_update.effective_user
+    other_update.effective_message.message_id = 1
+
+    await process_event("message", mock_update, mock_context)
+    await process_event("message", other_update, mock_context)
+
+    assert parse_rule.cache_info().misses == len({rule["script"] for rule in DEFAULT_RULES})
+    asts_a = [parsed for _, _, parsed in mock_context.bot_data['rule_cache'][-1001]]
+    asts_b = [parsed for _, _, parsed in mock_context.bot_data['rule_cache'][-1002]]
+    assert all(a is b for a, b in zip(asts_a, asts_b))
+
+
 @pytest.mark.asyncio
 @patch('src.bot.handlers.process_event', new_callable=AsyncMock)
 async def test_user_join_handler(mock_process_event, mock_update):
@@ -717,17 +822,12 @@ async def test_start_handler_with_valid_token(mock_send_challenge, mock_update,
 # =====================================================================
 
 @pytest.mark.asyncio
-async def test_is_user_admin_exception(mocker):
+async def test_is_user_admin_exception(mocker, mock_update, mock_context):
     """
     测试: 当 `get_chat_member` API调用失败时，`_is_user_admin` 应该捕获异常并返回 False。
     覆盖: src/bot/handlers.py 第55行
     """
-    mock_update = MagicMock()
-    mock_update.effective_chat.id = -1001
-    mock_update.effective_user.id = 123
-
-    mock_context = AsyncMock(spec=ContextTypes.DEFAULT_TYPE)
-    mock_context.bot.get_chat_member.side_effect = TelegramError("Test error")
+    mock_context.bot.get_chat_member = AsyncMock(side_effect=TelegramError("Test error"))
 
     # 模拟日志记录器以检查其是否被调用
     mock_logger = mocker.patch('src.bot.handlers.logger')
@@ -760,13 +860,25 @@ def test_seed_rules_if_new_group(dbsession):
     assert dbsession.query(Rule).filter_by(group_id=chat_id).count() > 0
 
 
+@pytest.mark.no_seed
+def test_seed_rules_if_new_group_disabled_by_marker(dbsession):
+    """
+    测试: 带有 `no_seed` 标记的测试中，`_seed_rules_if_new_group` 不应创建群组或植入任何规则。
+    """
+    chat_id = -100999
+
+    assert _seed_rules_if_new_group(chat_id, dbsession) is False
+    assert dbsession.query(Group).filter_by(id=chat_id).count() == 0
+    assert dbsession.query(Rule).filter_by(group_id=chat_id).count() == 0
+
+
 @pytest.mark.asyncio
 async def test_process_event_no_effective_chat():
     """
     测试: 当 Update 对象没有 `effective_chat` 时，`process_event` 应该直接返回。
     覆盖: src/bot/handlers.py 第113行
     """
-    mock_update = MagicMock(spec=User)
+    mock_update = MagicMock()
     mock_update.effective_chat = None
     mock_context = AsyncMock()
 
@@ -819,12 +931,12 @@ async def test_user_join_handler_no_chat_member(mocker):
     mock_process_event.assert_not_called()
 
 
-@pytest.mark.asyncio
 @pytest.mark.parametrize("args, command_text, expected_message", [
     ([], "/ruleon", "用法: /ruleon <规则ID>"),  # 无参数
     (["abc"], "/ruleon", "用法: /ruleon <规则ID>"), # 无效参数
     (["999"], "/ruleon", "错误：未找到ID为 999 的规则。") # 不存在的规则ID
 ])
+@pytest.mark.asyncio
 async def test_get_rule_from_command_error_paths(dbsession, test_group, args, command_text, expected_message, mocker):
     """
     测试: `_get_rule_from_command` 的各种错误路径。
@@ -870,11 +982,11 @@ async def test_get_rule_from_command_not_admin(dbsession, test_group, mocker):
     mock_update.message.reply_text.assert_called_once_with("抱歉，只有群组管理员才能使用此命令。")
 
 
-@pytest.mark.asyncio
 @pytest.mark.parametrize("args, expected_message", [
     (["verify_123_abc_bad"], "验证链接无效或格式错误。"), # 无效的 /start 参数
     ([], "欢迎使用机器人！") # 没有 /start 参数
 ])
+@pytest.mark.asyncio
 async def test_start_handler_paths(args, expected_message):
     """
     测试: `start_handler` 的不同路径，包括无效参数和无参数的情况。
@@ -903,8 +1015,7 @@ async def test_verification_timeout_handler_api_error(mocker, dbsession, test_us
     user_id = test_user.id
     group_id = test_group.id
 
-    v = Verification(group_id=group_id, user_id=user_id, correct_answer="123")
-    dbsession.add(v)
+    dbsession.execute(insert(Verification).values(group_id=group_id, user_id=user_id, correct_answer="123"))
     dbsession.commit()
 
     mock_context = AsyncMock()
@@ -1,75 +1,190 @@
 # tests/test_integration.py
 
 import pytest
-from unittest.mock import MagicMock, AsyncMock, patch
+from unittest.mock import MagicMock, AsyncMock, patch, call
 from datetime import datetime, timedelta, timezone
 import asyncio
+import json
+from types import SimpleNamespace
 
-from telegram import Message
+from telegram import Message, PhotoSize
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.engine.default import CacheStats
 from sqlalchemy.orm import sessionmaker
 
 from src.database import Base, Rule, Group, Verification, Log, EventLog, StateVariable, User
-from src.bot.handlers import process_event, verification_callback_handler
-from src.utils import generate_math_image
+from src.bot.handlers import process_event, verification_callback_handler, media_message_handler
+from src.bot.default_rules import DEFAULT_RULES
 
 # Mark all tests in this file as asyncio
-pytestmark = pytest.mark.asyncio
+# 所有测试都自行预置群组和规则，因此在模块级别统一关闭 `_seed_rules_if_new_group` 的默认规则植入 (见 conftest 中的 `no_seed`)。
+pytestmark = [pytest.mark.asyncio, pytest.mark.no_seed]
+
+# =================== 预置数据 ===================
+
+# 多个测试共用的预置行只在模块导入时构建一次，
+# 每个测试通过一条 Core insert 直接写入，无需构造 ORM 对象并经过 unit-of-work flush。
+TEST_GROUP_ROWS = [{"id": -1001, "name": "Test Group"}]
+HELLO_RULE_ROWS = [{
+    "group_id": -1001,
+    "name": "Hello Rule",
+    "script": "WHEN message WHERE message.text == 'hello' THEN { reply('world'); } END",
+}]
+
+
+# 默认规则集的预置行（与 `_seed_rules_if_new_group` 植入的内容一致），同样只在模块导入时构建一次。
+DEFAULT_RULE_ROWS = [{
+    "group_id": -1001,
+    "name": rule["name"],
+    "script": rule["script"],
+    "description": rule.get("description", ""),
+    "priority": rule.get("priority", 0),
+    "is_active": True,
+} for rule in DEFAULT_RULES]
+
+
+# 命令消息的 entities (只读，多个测试共用同一份)：长度分别对应 "/set"、"/get" 和 "/setit"、"/getit"
+BOT_COMMAND_ENTITIES_LEN4 = ({'type': 'bot_command', 'offset': 0, 'length': 4},)
+BOT_COMMAND_ENTITIES_LEN6 = ({'type': 'bot_command', 'offset': 0, 'length': 6},)
 
-# =================== Integration Tests ===================
 
-async def test_where_clause_allows_execution(mock_update, mock_context, test_db_session_factory):
+@pytest.fixture
+def seeded_group(test_db_session_factory):
+    """预置测试群组 (-1001)，返回其 ID。"""
+    with test_db_session_factory() as db:
+        db.execute(insert(Group), TEST_GROUP_ROWS)
+        db.commit()
+    return TEST_GROUP_ROWS[0]["id"]
+
+
+@pytest.fixture
+def rule_factory(seeded_group, test_db_session_factory):
     """
-    端到端测试：验证一个带 `WHERE` 子句的规则在条件为真时能被正确执行。
+    返回一个为预置群组添加规则的函数 `make(script, name="Test Rule", priority=0)`。
+    取代各个测试中重复的 "添加 Group + Rule + commit" 样板代码。
     """
-    # --- 1. 准备阶段 (Setup) ---
+    def make(script, name="Test Rule", priority=0):
+        with test_db_session_factory() as db:
+            db.execute(insert(Rule), [{"group_id": seeded_group, "name": name, "script": script, "priority": priority}])
+            db.commit()
+    return make
+
+
+@pytest.fixture
+def hello_rule_db(seeded_group, test_db_session_factory):
+    """预置一个群组 (-1001) 及一条 `message.text == 'hello'` 时回复 'world' 的规则。"""
     with test_db_session_factory() as db:
-        db.add(Group(id=-1001, name="Test Group"))
-        db.add(Rule(
-            group_id=-1001,
-            name="Hello Rule",
-            script="WHEN message WHERE message.text == 'hello' THEN { reply('world'); } END"
-        ))
+        db.execute(insert(Rule), HELLO_RULE_ROWS)
         db.commit()
+    return test_db_session_factory
 
-    mock_update.effective_message.text = "hello"
+
+@pytest.fixture
+def default_rules_db(test_db_session_factory):
+    """
+    预置一个群组 (-1001) 及完整的默认规则集。
+    直接通过一次 executemany 写入，配合 `no_seed` 标记，测试无需在执行阶段经过 `_seed_rules_if_new_group`。
+    """
+    with test_db_session_factory() as db:
+        db.execute(insert(Group), TEST_GROUP_ROWS)
+        db.execute(insert(Rule), DEFAULT_RULE_ROWS)
+        db.commit()
+    return test_db_session_factory
+
+
+# =================== Integration Tests ===================
+
+@pytest.mark.parametrize("text, expected_called", [
+    ("hello", True),
+    ("goodbye", False),
+], ids=["allows_execution", "blocks_execution"])
+async def test_where_clause(text, expected_called, mock_update, mock_context, hello_rule_db):
+    """
+    端到端测试：验证一个带 `WHERE` 子句的规则在条件为真时能被正确执行，在条件为假时会被正确地阻止。
+    """
+    # --- 1. 准备阶段 (Setup) ---
+    # 群组和规则已由 `hello_rule_db` fixture 预置
+
+    mock_update.effective_message.text = text
 
     # --- 2. 执行阶段 (Act) ---
-    with patch('src.bot.handlers._seed_rules_if_new_group', return_value=False):
-        await process_event("message", mock_update, mock_context)
+    await process_event("message", mock_update, mock_context)
 
     # --- 3. 验证阶段 (Assert) ---
-    mock_update.effective_message.reply_text.assert_called_once_with("world")
+    if expected_called:
+        mock_update.effective_message.reply_text.assert_called_once_with("world")
+    else:
+        # reply_text 方法不应该被调用
+        mock_update.effective_message.reply_text.assert_not_called()
 
 
-async def test_where_clause_blocks_execution(mock_update, mock_context, test_db_session_factory):
+async def test_process_event_query_count_independent_of_rule_count(mock_update, mock_context, test_db_session_factory, count_queries):
     """
-    端到端测试：验证一个带 `WHERE` 子句的规则在条件为假时会被正确地阻止。
+    性能回归测试：`process_event` 执行的 SQL 语句数量不应随群组中规则的数量增长 (N+1 查询)。
+    同时验证规则缓存命中后，后续事件不再查询规则表。
     """
     # --- 1. 准备阶段 (Setup) ---
+    small_group_id, large_group_id = -1001, -1002
+    script = "WHEN message THEN { reply('ok'); } END"
     with test_db_session_factory() as db:
-        db.add(Group(id=-1001, name="Test Group"))
-        db.add(Rule(
-            group_id=-1001,
-            name="Hello Rule",
-            script="WHEN message WHERE message.text == 'hello' THEN { reply('world'); } END"
-        ))
+        db.execute(insert(Group), [
+            {"id": small_group_id, "name": "Small Group"},
+            {"id": large_group_id, "name": "Large Group"},
+        ])
+        # 预先创建用户，避免第一次事件比第二次多出一条 INSERT INTO users
+        db.execute(insert(User), [{"id": mock_update.effective_user.id, "first_name": "Test", "is_bot": False, "username": "testuser"}])
+        db.execute(insert(Rule), [{"group_id": small_group_id, "name": "Rule 0", "script": script}] + [
+            {"group_id": large_group_id, "name": f"Rule {i}", "script": script} for i in range(5)
+        ])
         db.commit()
-
-    # 用户发送了不匹配的消息
-    mock_update.effective_message.text = "goodbye"
+    mock_update.effective_message.text = "hi"
 
     # --- 2. 执行阶段 (Act) ---
-    with patch('src.bot.handlers._seed_rules_if_new_group', return_value=False):
+    mock_update.effective_chat.id = small_group_id
+    with count_queries() as small_cold:
+        await process_event("message", mock_update, mock_context)
+
+    mock_update.effective_chat.id = large_group_id
+    with count_queries() as large_cold:
+        await process_event("message", mock_update, mock_context)
+    with count_queries() as large_warm:
         await process_event("message", mock_update, mock_context)
 
     # --- 3. 验证阶段 (Assert) ---
-    # reply_text 方法不应该被调用
-    mock_update.effective_message.reply_text.assert_not_called()
+    assert mock_update.effective_message.reply_text.await_count == 1 + 5 + 5
+    # 冷缓存: 查询用户 + 一次性加载全部规则 + 写入事件日志 (本模块关闭了默认规则植入的检查)
+    assert len(large_cold) == len(small_cold)
+    assert len(large_cold) <= 3
+    # 热缓存: 只剩查询用户和写入事件日志，不再访问规则表
+    assert len(large_warm) <= 2
+    assert not any("FROM rules" in statement for statement in large_warm)
+
+
+async def test_process_event_statements_hit_compiled_cache(mock_update, mock_context, hello_rule_db, test_db_engine):
+    """
+    性能回归测试：同一群组的后续事件执行的所有 SQL 语句都应命中引擎的编译缓存，
+    即 `process_event` 中的查询以可缓存的 SQL 表达式构造，而不是每次拼接新的 SQL 文本。
+    """
+    cache_stats = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        cache_stats.append((statement, context.cache_hit))
+
+    mock_update.effective_message.text = "hello"
+    await process_event("message", mock_update, mock_context)
+
+    event.listen(test_db_engine, "before_cursor_execute", _record)
+    try:
+        await process_event("message", mock_update, mock_context)
+    finally:
+        event.remove(test_db_engine, "before_cursor_execute", _record)
+
+    assert cache_stats
+    assert all(cache_hit == CacheStats.CACHE_HIT for _, cache_hit in cache_stats), cache_stats
 
 
-async def test_set_and_read_various_variable_types(mock_update, mock_context, test_db_session_factory):
+async def test_set_and_read_various_variable_types(mock_update, mock_context, rule_factory):
     """
     端到端测试：验证 `set_var` 对不同数据类型（布尔、数字、列表）的序列化和反序列化是否正确。
     """
@@ -77,42 +192,32 @@ async def test_set_and_read_various_variable_types(mock_update, mock_context, te
     # 关键修复：确保此测试中的 update 不被误认为是回复
     mock_update.effective_message.reply_to_message = None
 
-    with test_db_session_factory() as db:
-        db.add(Group(id=-1001, name="Test Group"))
-        # Rule to set variables
-        db.add(Rule(
-            group_id=-1001, name="Set Vars", priority=2,
-            script="""
-            WHEN command WHERE command.name == 'set' THEN {
-                set_var("user.is_cool", true);
-                set_var("user.age", 42);
-                set_var("group.items", [1, "b", false]);
-            } END
-            """
-        ))
-        # Rule to read variables
-        db.add(Rule(
-            group_id=-1001, name="Get Vars", priority=1,
-            script="""
-            WHEN command WHERE command.name == 'get' AND vars.user.is_cool == true THEN {
-                reply(vars.user.age + 1);
-                delete_message();
-            } END
-            """
-        ))
-        db.commit()
+    # Rule to set variables
+    rule_factory("""
+        WHEN command WHERE command.name == 'set' THEN {
+            set_var("user.is_cool", true);
+            set_var("user.age", 42);
+            set_var("group.items", [1, "b", false]);
+        } END
+        """, name="Set Vars", priority=2)
+    # Rule to read variables
+    rule_factory("""
+        WHEN command WHERE command.name == 'get' AND vars.user.is_cool == true THEN {
+            reply(vars.user.age + 1);
+            delete_message();
+        } END
+        """, name="Get Vars", priority=1)
 
-    with patch('src.bot.handlers._seed_rules_if_new_group', return_value=False):
-        # --- 2. 执行阶段 (Act) ---
-        # 第一次调用，设置变量
-        mock_update.message.text = "/set"
-        mock_update.message.entities = [{'type': 'bot_command', 'offset': 0, 'length': 4}]
-        await process_event("command", mock_update, mock_context)
+    # --- 2. 执行阶段 (Act) ---
+    # 第一次调用，设置变量
+    mock_update.message.text = "/set"
+    mock_update.message.entities = BOT_COMMAND_ENTITIES_LEN4
+    await process_event("command", mock_update, mock_context)
 
-        # 第二次调用，读取变量并回复
-        mock_update.message.text = "/get"
-        mock_update.message.entities = [{'type': 'bot_command', 'offset': 0, 'length': 4}]
-        await process_event("command", mock_update, mock_context)
+    # 第二次调用，读取变量并回复
+    mock_update.message.text = "/get"
+    mock_update.message.entities = BOT_COMMAND_ENTITIES_LEN4
+    await process_event("command", mock_update, mock_context)
 
     # --- 3. 验证阶段 (Assert) ---
     # 验证 `set_var` 规则没有回复
@@ -122,7 +227,7 @@ async def test_set_and_read_various_variable_types(mock_update, mock_context, te
     mock_update.effective_message.delete.assert_called_once()
 
 
-async def test_set_var_for_specific_user(mock_update, mock_context, test_db_session_factory):
+async def test_set_var_for_specific_user(mock_update, mock_context, rule_factory):
     """
     端到端测试：验证 set_var 可以为一个显式指定 user_id 的用户设置变量。
     """
@@ -130,44 +235,34 @@ async def test_set_var_for_specific_user(mock_update, mock_context, test_db_sess
     admin_user_id = 123
     target_user_id = 555
 
-    with test_db_session_factory() as db:
-        db.add(Group(id=-1001, name="Test Group"))
-        # 规则1: 管理员 (123) 为目标用户 (555) 设置一个变量
-        db.add(Rule(
-            group_id=-1001, name="Set Var For Other", priority=2,
-            script=f"""
-            WHEN command WHERE command.name == 'setit' THEN {{
-                set_var("user.points", 100, {target_user_id});
-            }} END
-            """
-        ))
-        # 规则2: 目标用户 (555) 读取自己的变量并作出回应
-        db.add(Rule(
-            group_id=-1001, name="Get Var For Self", priority=1,
-            script=f"""
-            WHEN command WHERE command.name == 'getit' THEN {{
-                reply(vars.user_{target_user_id}.points);
-            }} END
-            """
-        ))
-        db.commit()
+    # 规则1: 管理员 (123) 为目标用户 (555) 设置一个变量
+    rule_factory(f"""
+        WHEN command WHERE command.name == 'setit' THEN {{
+            set_var("user.points", 100, {target_user_id});
+        }} END
+        """, name="Set Var For Other", priority=2)
+    # 规则2: 目标用户 (555) 读取自己的变量并作出回应
+    rule_factory(f"""
+        WHEN command WHERE command.name == 'getit' THEN {{
+            reply(vars.user_{target_user_id}.points);
+        }} END
+        """, name="Get Var For Self", priority=1)
 
-    with patch('src.bot.handlers._seed_rules_if_new_group', return_value=False):
-        # --- 2. 执行阶段 (Act) ---
-        # 模拟管理员 (123) 执行设置命令
-        mock_update.effective_user.id = admin_user_id
-        mock_update.message.text = "/setit"
-        mock_update.message.entities = [{'type': 'bot_command', 'offset': 0, 'length': 6}]
-        await process_event("command", mock_update, mock_context)
+    # --- 2. 执行阶段 (Act) ---
+    # 模拟管理员 (123) 执行设置命令
+    mock_update.effective_user.id = admin_user_id
+    mock_update.message.text = "/setit"
+    mock_update.message.entities = BOT_COMMAND_ENTITIES_LEN6
+    await process_event("command", mock_update, mock_context)
 
-        # 验证第一次调用没有产生回复
-        mock_update.effective_message.reply_text.assert_not_called()
+    # 验证第一次调用没有产生回复
+    mock_update.effective_message.reply_text.assert_not_called()
 
-        # 模拟目标用户 (555) 执行读取命令
-        mock_update.effective_user.id = target_user_id
-        mock_update.message.text = "/getit"
-        mock_update.message.entities = [{'type': 'bot_command', 'offset': 0, 'length': 6}]
-        await process_event("command", mock_update, mock_context)
+    # 模拟目标用户 (555) 执行读取命令
+    mock_update.effective_user.id = target_user_id
+    mock_update.message.text = "/getit"
+    mock_update.message.entities = BOT_COMMAND_ENTITIES_LEN6
+    await process_event("command", mock_update, mock_context)
 
     # --- 3. 验证阶段 (Assert) ---
     # 验证目标用户读取到了由管理员设置的值
@@ -177,16 +272,9 @@ async def test_set_var_for_specific_user(mock_update, mock_context, test_db_sess
 
 # =================== Action Tests ===================
 
-async def test_ban_user_action(mock_update, mock_context, test_db_session_factory):
+async def test_ban_user_action(mock_update, mock_context, rule_factory):
     """测试 ban_user 动作是否能正确调用 bot 的 API。"""
-    with test_db_session_factory() as db:
-        db.add(Group(id=-1001, name="Test Group"))
-        db.add(Rule(
-            group_id=-1001,
-            name="Ban Rule",
-            script="""WHEN command WHERE command.name == 'ban' THEN { ban_user(12345, "test reason"); } END"""
-        ))
-        db.commit()
+    rule_factory("""WHEN command WHERE command.name == 'ban' THEN { ban_user(12345, "test reason"); } END""", name="Ban Rule")
 
     mock_update.message.text = "/ban"
     await process_event("command", mock_update, mock_context)
@@ -197,16 +285,9 @@ async def test_ban_user_action(mock_update, mock_context, test_db_session_factor
         12345
     )
 
-async def test_mute_user_action(mock_update, mock_context, test_db_session_factory):
+async def test_mute_user_action(mock_update, mock_context, rule_factory):
     """测试 mute_user 动作是否能正确解析时长并调用 bot 的 API。"""
-    with test_db_session_factory() as db:
-        db.add(Group(id=-1001, name="Test Group"))
-        db.add(Rule(
-            group_id=-1001,
-            name="Mute Rule",
-            script="""WHEN command WHERE command.name == 'mute' THEN { mute_user("1h", 54321); } END"""
-        ))
-        db.commit()
+    rule_factory("""WHEN command WHERE command.name == 'mute' THEN { mute_user("1h", 54321); } END""", name="Mute Rule")
 
     mock_update.message.text = "/mute"
     await process_event("command", mock_update, mock_context)
@@ -223,21 +304,20 @@ async def test_mute_user_action(mock_update, mock_context, test_db_session_facto
 
 # =================== Verification Flow Tests ===================
 
-async def test_user_join_triggers_verification(mock_update, mock_context, test_db_session_factory):
+async def test_user_join_triggers_verification(mock_update, mock_context, default_rules_db):
     """
     测试当一个新用户加入时，是否会正确触发 `start_verification` 动作。
-    此测试依赖于 `_seed_rules_if_new_group` 的正确行为，它会自动为新群组安装默认规则。
+    默认规则集由 `default_rules_db` fixture 预置（默认规则的植入本身由 test_handlers 中的
+    `test_seed_rules_if_new_group` 覆盖）。
     """
     # --- 1. 准备阶段 (Setup) ---
-    # 确保数据库中没有这个群组，这样 `_seed_rules_if_new_group` 就会被触发
     mock_context.bot.username = "TestBot"
     # 关键：显式设置 is_bot 为 False，以满足规则的 WHERE 条件
     mock_update.effective_user.is_bot = False
 
     # --- 2. 执行阶段 (Act) ---
-    # 模拟 `user_join` 事件。这将导致 `process_event` 调用 `_seed_rules_if_new_group`，
-    # 它会创建群组并添加包括“入群验证”在内的所有默认规则。然后，规则缓存将被填充，
-    # `user_join` 事件会匹配到相应规则并执行 `start_verification` 动作。
+    # 模拟 `user_join` 事件。规则缓存将从预置的默认规则中填充，
+    # `user_join` 事件会匹配到“入群验证”规则并执行 `start_verification` 动作。
     await process_event("user_join", mock_update, mock_context)
 
     # --- 3. 验证阶段 (Assert) ---
@@ -251,75 +331,84 @@ async def test_user_join_triggers_verification(mock_update, mock_context, test_d
     mock_context.bot.send_message.assert_called_once()
     args, kwargs = mock_context.bot.send_message.call_args
     assert kwargs.get('chat_id') == -1001
-    assert "点此开始验证" in str(kwargs.get('reply_markup'))
-    assert "https://t.me/TestBot?start=verify_-1001_123" in str(kwargs.get('reply_markup'))
+    button = kwargs['reply_markup'].inline_keyboard[0][0]
+    assert button.text == "点此开始验证"
+    assert button.url == "https://t.me/TestBot?start=verify_-1001_123"
 
 
-async def test_verification_callback_success(mock_update, mock_context, test_db_session_factory):
+@pytest.mark.parametrize("attempts, answer, expected_text, expected_kick", [
+    # 用户点击了正确的验证答案：解除禁言
+    (1, "42", "✅ 验证成功！您现在可以在群组中发言了。", False),
+    # 用户在最后一次机会也回答错误：被踢出群组
+    (3, "99", "❌ 验证失败次数过多，您已被移出群组。", True),
+], ids=["success", "failure_and_kick"])
+async def test_verification_callback_outcome(attempts, answer, expected_text, expected_kick, mock_update, mock_context, test_db_session_factory):
     """
-    测试用户点击了正确的验证答案后的成功流程。
-    这个测试现在还验证了动态权限获取的逻辑。
+    测试验证回调的两种最终结果：回答正确后的成功流程（包括动态权限获取的逻辑），
+    以及最后一次机会也回答错误后被踢出群组的流程。
+    两种情况下验证记录都应被删除。
     """
     # --- 1. 准备阶段 (Setup) ---
     group_id = -1001
     user_id = 123
-    correct_answer = "42"
 
     # 创建一个我们将要模拟返回的、独特的权限对象
-    mock_permissions = MagicMock()
-    mock_permissions.can_send_messages = True
-    mock_permissions.can_invite_users = False # 设置一个非默认值以确保我们验证的是这个对象
-
-    # 创建模拟的 Chat 对象
-    mock_chat = MagicMock()
-    mock_chat.permissions = mock_permissions
-
-    # 配置 context.bot.get_chat 以返回我们的模拟 Chat 对象
-    mock_context.bot.get_chat = AsyncMock(return_value=mock_chat)
-
+    # (这两个对象只被原样传递，不需要 MagicMock 的调用记录，用 SimpleNamespace 即可)
+    # can_invite_users 设置为非默认值，以确保我们验证的是这个对象
+    mock_permissions = SimpleNamespace(can_send_messages=True, can_invite_users=False)
+    mock_chat = SimpleNamespace(permissions=mock_permissions)
+
+    # get_chat 只会被调用一次：用一个普通的协程函数作为 side_effect，
+    # MagicMock 负责记录调用参数，省去 AsyncMock 每次调用时的额外包装。
+    async def _get_chat(**kwargs):
+        return mock_chat
+    mock_context.bot.get_chat = MagicMock(side_effect=_get_chat)
+
+    # 同一个会话贯穿准备、执行和验证阶段，验证阶段无需再新开会话/连接
     with test_db_session_factory() as db:
         # 在数据库中预置一个待验证的记录
-        verification = Verification(
+        # (直接使用 Core insert，跳过 ORM 的 unit-of-work flush，这只是测试的预置数据)
+        db.execute(insert(Verification).values(
             group_id=group_id,
             user_id=user_id,
-            correct_answer=correct_answer,
-            attempts_made=1
-        )
-        db.add(verification)
+            correct_answer="42",
+            attempts_made=attempts
+        ))
         db.commit()
 
-    # 模拟用户点击了正确答案按钮
-    mock_update.callback_query.data = f"verify_{group_id}_{user_id}_{correct_answer}"
-    mock_update.callback_query.from_user.id = user_id
-
-    # 模拟 JobQueue.get_jobs_by_name 返回一个空列表
-    mock_context.job_queue.get_jobs_by_name.return_value = []
-
-    # --- 2. 执行阶段 (Act) ---
-    await verification_callback_handler(mock_update, mock_context)
-
-    # --- 3. 验证阶段 (Assert) ---
-    # 1. 验证 get_chat 被调用以获取动态权限
-    mock_context.bot.get_chat.assert_called_once_with(chat_id=group_id)
-
-    # 2. 验证用户被解除禁言，并且使用的是我们模拟的权限对象
-    mock_context.bot.restrict_chat_member.assert_called_once_with(
-        chat_id=group_id,
-        user_id=user_id,
-        permissions=mock_permissions
-    )
+        mock_update.callback_query.data = f"verify_{group_id}_{user_id}_{answer}"
+        mock_update.callback_query.from_user.id = user_id
+        mock_context.job_queue.get_jobs_by_name.return_value = []
 
-    # 3. 验证机器人编辑了消息，提示成功
-    mock_update.callback_query.edit_message_text.assert_called_once_with(
-        text="✅ 验证成功！您现在可以在群组中发言了。"
-    )
-
-    # 3. 验证数据库中的记录已被删除
-    with test_db_session_factory() as db:
-        v = db.query(Verification).filter_by(user_id=user_id).first()
-        assert v is None
+        # --- 2. 执行阶段 (Act) ---
+        await verification_callback_handler(mock_update, mock_context)
 
-async def test_integration_chain_assignment_in_warning_rule(mock_update, mock_context, test_db_session_factory):
+        # --- 3. 验证阶段 (Assert) ---
+        # 用一次结构化比较同时验证调用的内容、顺序和数量，多出的任何 API 调用都会让断言失败。
+        if expected_kick:
+            # 用户被踢出 (先 ban 后 unban)，且没有被解除禁言
+            expected_bot_calls = [
+                call.ban_chat_member(chat_id=group_id, user_id=user_id),
+                call.unban_chat_member(chat_id=group_id, user_id=user_id),
+            ]
+        else:
+            # get_chat 被调用以获取动态权限，并且用户使用该权限对象被解除禁言
+            expected_bot_calls = [
+                call.get_chat(chat_id=group_id),
+                call.restrict_chat_member(chat_id=group_id, user_id=user_id, permissions=mock_permissions),
+            ]
+        assert mock_context.bot.method_calls == expected_bot_calls
+        # 机器人应答了回调并编辑了消息，提示结果
+        assert mock_update.callback_query.method_calls == [
+            call.answer(),
+            call.edit_message_text(text=expected_text),
+        ]
+
+        # 验证数据库中的记录已被删除
+        db.expire_all()
+        assert db.get(Verification, (user_id, group_id)) is None
+
+async def test_integration_chain_assignment_in_warning_rule(mock_update, mock_context, test_db_session_factory, rule_factory):
     """
     集成测试: 验证链式赋值和 set_var/get_var 在“警告与自动封禁”场景中能正确工作。
     """
@@ -349,35 +438,31 @@ async def test_integration_chain_assignment_in_warning_rule(mock_update, mock_co
         }}
     }} END
     """
-    with test_db_session_factory() as db:
-        db.add(Group(id=group_id, name="Test Group"))
-        db.add(Rule(group_id=group_id, name="Chain Assign Warn", script=warn_rule))
-        db.commit()
+    rule_factory(warn_rule, name="Chain Assign Warn")
 
-    with patch('src.bot.handlers._seed_rules_if_new_group', return_value=False):
-        mock_update.effective_user.id = admin_id
+    mock_update.effective_user.id = admin_id
 
-        # --- 2. 第一次警告 ---
-        mock_update.message.text = f"/warn {target_user_id}"
-        await process_event("command", mock_update, mock_context)
-        # 验证 reply 使用了正确的返回值 (1)
-        mock_update.effective_message.reply_text.assert_called_once_with(f"用户 {target_user_id} 的最新警告次数为: 1")
-        mock_update.effective_message.reply_text.reset_mock()
-        mock_context.bot.ban_chat_member.assert_not_called()
+    # --- 2. 第一次警告 ---
+    mock_update.message.text = f"/warn {target_user_id}"
+    await process_event("command", mock_update, mock_context)
+    # 验证 reply 使用了正确的返回值 (1)
+    mock_update.effective_message.reply_text.assert_called_once_with(f"用户 {target_user_id} 的最新警告次数为: 1")
+    mock_update.effective_message.reply_text.reset_mock()
+    mock_context.bot.ban_chat_member.assert_not_called()
 
-        # --- 3. 第二次警告 (导致封禁) ---
-        await process_event("command", mock_update, mock_context)
-        # 验证 reply 使用了正确的返回值 (2)
-        mock_update.effective_message.reply_text.assert_called_once_with(f"用户 {target_user_id} 的最新警告次数为: 2")
-        mock_context.bot.ban_chat_member.assert_called_once_with(group_id, target_user_id)
+    # --- 3. 第二次警告 (导致封禁) ---
+    await process_event("command", mock_update, mock_context)
+    # 验证 reply 使用了正确的返回值 (2)
+    mock_update.effective_message.reply_text.assert_called_once_with(f"用户 {target_user_id} 的最新警告次数为: 2")
+    mock_context.bot.ban_chat_member.assert_called_once_with(group_id, target_user_id)
 
-        # --- 4. 验证数据库 ---
-        with test_db_session_factory() as db:
-            # 验证变量已被清空 (set_var with null)
-            final_var = db.query(StateVariable).filter_by(group_id=group_id, user_id=target_user_id, name="warnings").first()
-            assert final_var is None
+    # --- 4. 验证数据库 ---
+    with test_db_session_factory() as db:
+        # 验证变量已被清空 (set_var with null)
+        final_var = db.query(StateVariable).filter_by(group_id=group_id, user_id=target_user_id, name="warnings").first()
+        assert final_var is None
 
-async def test_integration_foreach_with_actions(mock_update, mock_context, test_db_session_factory):
+async def test_integration_foreach_with_actions(mock_update, mock_context, test_db_session_factory, rule_factory):
     """
     集成测试: 验证 foreach 循环与动作调用（特别是带 continue）的交互。
     """
@@ -398,17 +483,13 @@ async def test_integration_foreach_with_actions(mock_update, mock_context, test_
         }
     } END
     """
-    with test_db_session_factory() as db:
-        db.add(Group(id=group_id, name="Test Group"))
-        db.add(Rule(group_id=group_id, name="Batch Kick Rule", script=script))
-        db.commit()
+    rule_factory(script, name="Batch Kick Rule")
 
-    with patch('src.bot.handlers._seed_rules_if_new_group', return_value=False):
-        # --- 2. 执行 ---
-        # 命令包含管理员自己，应该被 continue 跳过
-        mock_update.effective_user.id = admin_id
-        mock_update.message.text = f"/multikick 456 {admin_id} 789"
-        await process_event("command", mock_update, mock_context)
+    # --- 2. 执行 ---
+    # 命令包含管理员自己，应该被 continue 跳过
+    mock_update.effective_user.id = admin_id
+    mock_update.message.text = f"/multikick 456 {admin_id} 789"
+    await process_event("command", mock_update, mock_context)
 
     # --- 3. 验证 ---
     # 验证 kick_user (ban+unban) 被调用了两次
@@ -430,7 +511,7 @@ async def test_integration_foreach_with_actions(mock_update, mock_context, test_
         assert logs[1].message == "Kicked 789"
 
 
-async def test_media_group_is_processed_as_single_event(mock_update, mock_context, test_db_session_factory):
+async def test_media_group_is_processed_as_single_event(mock_update, mock_context, test_db_session_factory, rule_factory):
     """
     集成测试: 验证一个媒体组被正确地聚合，并作为一个单独的 'media_group' 事件来处理。
     """
@@ -443,22 +524,14 @@ async def test_media_group_is_processed_as_single_event(mock_update, mock_contex
     mock_update.effective_chat.id = group_id
     mock_update.effective_user.id = user_id
 
+    # 修复: 必须添加一个监听 'media_group' 事件的规则，否则 RuleExecutor 不会被调用
+    anti_flood_rule_data = next(r for r in DEFAULT_RULES if r["name"] == "[防刷屏] 消息防刷屏")
+    rule_factory(anti_flood_rule_data["script"], name=anti_flood_rule_data["name"])
     with test_db_session_factory() as db:
-        db.add(Group(id=group_id, name="Test Group"))
         db.add(User(id=user_id, first_name="Test", is_bot=False))
-        # 修复: 必须添加一个监听 'media_group' 事件的规则，否则 RuleExecutor 不会被调用
-        from src.bot.default_rules import DEFAULT_RULES
-        anti_flood_rule_data = next(r for r in DEFAULT_RULES if r["name"] == "[防刷屏] 消息防刷屏")
-        db.add(Rule(
-            group_id=group_id,
-            name=anti_flood_rule_data["name"],
-            script=anti_flood_rule_data["script"],
-            is_active=True
-        ))
         db.commit()
 
     # 创建媒体组中的三条独立消息
-    from telegram import PhotoSize
     photo_size = PhotoSize(width=100, height=100, file_id="file1", file_unique_id="unique1")
     msg1 = MagicMock(spec=Message)
     msg1.message_id = 101
@@ -488,7 +561,6 @@ async def test_media_group_is_processed_as_single_event(mock_update, mock_contex
         mock_instance.execute_rule = AsyncMock()
 
         # --- 2. 执行阶段 (Act) ---
-        from src.bot.handlers import media_message_handler
         # 为测试初始化聚合器字典和模拟的 job_queue
         mock_context.bot_data['media_group_aggregator'] = {}
         mock_context.bot_data['media_group_jobs'] = {}
@@ -527,70 +599,79 @@ async def test_media_group_is_processed_as_single_event(mock_update, mock_contex
             # 验证 message_id 是否被正确记录为媒体组中第一条消息的 ID
             assert event_logs[0].message_id == msg1.message_id
 
-async def test_full_warning_system_scenario(mock_update, mock_context, test_db_session_factory):
+# 三振出局（three-strikes-you're-out）警告系统的规则，供下面两个测试共用
+WARN_RULE = """
+WHEN command WHERE command.name == 'warn' and command.arg_count > 0 THEN {
+    target_id = int(command.arg[0]);
+    // 使用新的 get_var 函数来为动态指定的用户读取变量
+    current_warnings = get_var("user.warnings", 0, target_id);
+    new_warnings = current_warnings + 1;
+    set_var("user.warnings", new_warnings, target_id);
+
+    if (new_warnings >= 3) {
+        reply("用户 " + target_id + " 已达到3次警告，将被踢出。");
+        kick_user(target_id);
+        // 踢出后重置警告计数
+        set_var("user.warnings", 0, target_id);
+    } else {
+        reply("用户 " + target_id + " 已被警告，当前警告次数: " + new_warnings);
+    }
+} END
+"""
+
+
+async def test_warning_system_increments(mock_update, mock_context, test_db_session_factory, rule_factory):
     """
-    一个完整的端到端测试，模拟一个三振出局（three-strikes-you're-out）的警告系统。
+    端到端测试：警告系统中，一次警告会将目标用户的警告计数加一并回复当前次数，不会踢人。
     """
     # --- 1. 准备阶段 (Setup) ---
-    admin_id = 123
-    target_user_id = 456
-    group_id = -1001
+    admin_id, target_user_id, group_id = 123, 456, -1001
+    rule_factory(WARN_RULE, name="Warning System")
+    mock_update.effective_user.id = admin_id
 
-    warn_rule = """
-    WHEN command WHERE command.name == 'warn' and command.arg_count > 0 THEN {
-        target_id = int(command.arg[0]);
-        // 使用新的 get_var 函数来为动态指定的用户读取变量
-        current_warnings = get_var("user.warnings", 0, target_id);
-        new_warnings = current_warnings + 1;
-        set_var("user.warnings", new_warnings, target_id);
-
-        if (new_warnings >= 3) {
-            reply("用户 " + target_id + " 已达到3次警告，将被踢出。");
-            kick_user(target_id);
-            // 踢出后重置警告计数
-            set_var("user.warnings", 0, target_id);
-        } else {
-            reply("用户 " + target_id + " 已被警告，当前警告次数: " + new_warnings);
-        }
-    } END
-    """
-    with test_db_session_factory() as db:
-        db.add(Group(id=group_id, name="Test Group"))
-        db.add(Rule(group_id=group_id, name="Warning System", script=warn_rule))
-        db.commit()
-
-    with patch('src.bot.handlers._seed_rules_if_new_group', return_value=False):
-        mock_update.effective_user.id = admin_id # 管理员发出所有警告
+    # --- 2. 执行阶段 (Act) ---
+    mock_update.message.text = f"/warn {target_user_id}"
+    await process_event("command", mock_update, mock_context)
 
-        # --- 2. 第一次警告 ---
-        mock_update.message.text = f"/warn {target_user_id}"
-        await process_event("command", mock_update, mock_context)
-        mock_update.effective_message.reply_text.assert_called_once_with(f"用户 {target_user_id} 已被警告，当前警告次数: 1")
-        mock_update.effective_message.reply_text.reset_mock()
+    # --- 3. 验证阶段 (Assert) ---
+    mock_update.effective_message.reply_text.assert_called_once_with(f"用户 {target_user_id} 已被警告，当前警告次数: 1")
+    mock_context.bot.ban_chat_member.assert_not_called()
+    with test_db_session_factory() as db:
+        var = db.query(StateVariable).filter_by(group_id=group_id, user_id=target_user_id, name="warnings").one()
+        assert json.loads(var.value) == 1
 
-        # --- 3. 第二次警告 ---
-        await process_event("command", mock_update, mock_context)
-        mock_update.effective_message.reply_text.assert_called_once_with(f"用户 {target_user_id} 已被警告，当前警告次数: 2")
-        mock_update.effective_message.reply_text.reset_mock()
 
-        # --- 4. 第三次警告 (导致踢出) ---
-        await process_event("command", mock_update, mock_context)
-        mock_update.effective_message.reply_text.assert_called_once_with(f"用户 {target_user_id} 已达到3次警告，将被踢出。")
+async def test_warning_system_kicks_on_third(mock_update, mock_context, test_db_session_factory, rule_factory):
+    """
+    端到端测试：目标用户已有 2 次警告时，第三次警告会踢出该用户并将警告计数重置为 0。
+    (直接预置警告计数，而不是重复经过两次只覆盖“计数加一”分支的完整事件处理。)
+    """
+    # --- 1. 准备阶段 (Setup) ---
+    admin_id, target_user_id, group_id = 123, 456, -1001
+    rule_factory(WARN_RULE, name="Warning System")
+    with test_db_session_factory() as db:
+        db.execute(insert(StateVariable), [
+            {"group_id": group_id, "user_id": target_user_id, "name": "warnings", "value": json.dumps(2)},
+        ])
+        db.commit()
+    mock_update.effective_user.id = admin_id
 
-        # 验证踢出动作被调用
-        mock_context.bot.ban_chat_member.assert_called_once_with(group_id, target_user_id)
-        mock_context.bot.unban_chat_member.assert_called_once_with(group_id, target_user_id)
+    # --- 2. 执行阶段 (Act) ---
+    mock_update.message.text = f"/warn {target_user_id}"
+    await process_event("command", mock_update, mock_context)
 
-        # --- 5. 验证数据库状态 ---
-        # 验证警告计数已被重置为0
-        with test_db_session_factory() as db:
-            from src.database import StateVariable
-            import json
-            final_var = db.query(StateVariable).filter_by(group_id=group_id, user_id=target_user_id, name="warnings").one()
-            assert json.loads(final_var.value) == 0
+    # --- 3. 验证阶段 (Assert) ---
+    mock_update.effective_message.reply_text.assert_called_once_with(f"用户 {target_user_id} 已达到3次警告，将被踢出。")
+    # 验证踢出动作被调用
+    mock_context.bot.ban_chat_member.assert_called_once_with(group_id, target_user_id)
+    mock_context.bot.unban_chat_member.assert_called_once_with(group_id, target_user_id)
+    # 验证警告计数已被重置为0
+    with test_db_session_factory() as db:
+        final_var = db.query(StateVariable).filter_by(group_id=group_id, user_id=target_user_id, name="warnings").one()
+        assert json.loads(final_var.value) == 0
 
 
-async def test_stats_variables(mock_update, mock_context, test_db_session_factory):
+async def test_stats_variables(mock_update, mock_context, test_db_session_factory, rule_factory, frozen_now):
     """
     集成测试：验证新的 user.stats.* 和 group.stats.* 变量能否正确工作。
     """
@@ -605,37 +686,37 @@ async def test_stats_variables(mock_update, mock_context, test_db_session_factor
     user_id = mock_update.effective_user.id
     other_user_id = 456
     group_id = mock_update.effective_chat.id
-    now = datetime.now(timezone.utc)
+    now = frozen_now
 
+    rule_factory(stats_rule, name="Stats Rule")
     with test_db_session_factory() as db:
-        db.add(Group(id=group_id, name="Test Group"))
-        db.add(Rule(group_id=group_id, name="Stats Rule", script=stats_rule))
-        # 准备事件日志
-        # 当前用户的消息
-        db.add(EventLog(group_id=group_id, user_id=user_id, event_type='message', message_id=1, timestamp=now - timedelta(minutes=10)))
-        db.add(EventLog(group_id=group_id, user_id=user_id, event_type='message', message_id=2, timestamp=now - timedelta(minutes=30)))
-        db.add(EventLog(group_id=group_id, user_id=user_id, event_type='message', message_id=3, timestamp=now - timedelta(hours=2))) # 1小时外
-        # 其他用户的消息
-        db.add(EventLog(group_id=group_id, user_id=other_user_id, event_type='message', message_id=4, timestamp=now - timedelta(minutes=5)))
-        # 入群/离群事件
-        db.add(EventLog(group_id=group_id, user_id=other_user_id, event_type='user_join', timestamp=now - timedelta(hours=12)))
-        db.add(EventLog(group_id=group_id, user_id=user_id, event_type='user_leave', timestamp=now - timedelta(hours=20)))
-        db.add(EventLog(group_id=group_id, user_id=other_user_id, event_type='user_leave', timestamp=now - timedelta(days=2))) # 1天外
+        # 准备事件日志 (一次 executemany 写入全部行)
+        db.execute(insert(EventLog), [
+            # 当前用户的消息
+            {"group_id": group_id, "user_id": user_id, "event_type": "message", "message_id": 1, "timestamp": now - timedelta(minutes=10)},
+            {"group_id": group_id, "user_id": user_id, "event_type": "message", "message_id": 2, "timestamp": now - timedelta(minutes=30)},
+            {"group_id": group_id, "user_id": user_id, "event_type": "message", "message_id": 3, "timestamp": now - timedelta(hours=2)}, # 1小时外
+            # 其他用户的消息
+            {"group_id": group_id, "user_id": other_user_id, "event_type": "message", "message_id": 4, "timestamp": now - timedelta(minutes=5)},
+            # 入群/离群事件
+            {"group_id": group_id, "user_id": other_user_id, "event_type": "user_join", "message_id": None, "timestamp": now - timedelta(hours=12)},
+            {"group_id": group_id, "user_id": user_id, "event_type": "user_leave", "message_id": None, "timestamp": now - timedelta(hours=20)},
+            {"group_id": group_id, "user_id": other_user_id, "event_type": "user_leave", "message_id": None, "timestamp": now - timedelta(days=2)}, # 1天外
+        ])
         db.commit()
 
     # --- 2. 执行与验证 ---
-    with patch('src.bot.handlers._seed_rules_if_new_group', return_value=False):
-        mock_update.message.text = "/stats"
-        await process_event("command", mock_update, mock_context)
+    mock_update.message.text = "/stats"
+    await process_event("command", mock_update, mock_context)
 
-        # user.stats.messages_1h: 应该只有2条
-        # group.stats.joins_24h: 应该只有1条
-        # user.stats.leaves_1d: 应该只有1条
-        expected_reply = "user_msg_1h:2, group_joins_24h:1, user_leaves_1d:1"
-        mock_update.effective_message.reply_text.assert_called_once_with(expected_reply)
+    # user.stats.messages_1h: 应该只有2条
+    # group.stats.joins_24h: 应该只有1条
+    # user.stats.leaves_1d: 应该只有1条
+    expected_reply = "user_msg_1h:2, group_joins_24h:1, user_leaves_1d:1"
+    mock_update.effective_message.reply_text.assert_called_once_with(expected_reply)
 
 
-async def test_user_stats_variable_with_caching(mock_update, mock_context, test_db_session_factory):
+async def test_user_stats_variable_with_caching(mock_update, mock_context, test_db_session_factory, rule_factory, frozen_now, count_queries):
     """
     集成测试：验证新的 user.stats.* 变量能否正确工作，并测试其缓存机制。
     """
@@ -648,62 +729,50 @@ async def test_user_stats_variable_with_caching(mock_update, mock_context, test_
     user_id = mock_update.effective_user.id
     group_id = mock_update.effective_chat.id
 
+    rule_factory(stats_rule, name="Stats Rule")
     with test_db_session_factory() as db:
-        db.add(Group(id=group_id, name="Test Group"))
-        db.add(Rule(group_id=group_id, name="Stats Rule", script=stats_rule))
-        # 添加3条在最近1小时内的消息
-        db.add(EventLog(group_id=group_id, user_id=user_id, event_type='message', message_id=1, timestamp=datetime.now(timezone.utc) - timedelta(minutes=10)))
-        db.add(EventLog(group_id=group_id, user_id=user_id, event_type='message', message_id=2, timestamp=datetime.now(timezone.utc) - timedelta(minutes=20)))
-        db.add(EventLog(group_id=group_id, user_id=user_id, event_type='message', message_id=3, timestamp=datetime.now(timezone.utc) - timedelta(minutes=30)))
-        # 添加1条在1小时外的消息
-        db.add(EventLog(group_id=group_id, user_id=user_id, event_type='message', message_id=4, timestamp=datetime.now(timezone.utc) - timedelta(hours=2)))
+        db.execute(insert(EventLog), [
+            # 3条在最近1小时内的消息
+            {"group_id": group_id, "user_id": user_id, "event_type": "message", "message_id": 1, "timestamp": frozen_now - timedelta(minutes=10)},
+            {"group_id": group_id, "user_id": user_id, "event_type": "message", "message_id": 2, "timestamp": frozen_now - timedelta(minutes=20)},
+            {"group_id": group_id, "user_id": user_id, "event_type": "message", "message_id": 3, "timestamp": frozen_now - timedelta(minutes=30)},
+            # 1条在1小时外的消息
+            {"group_id": group_id, "user_id": user_id, "event_type": "message", "message_id": 4, "timestamp": frozen_now - timedelta(hours=2)},
+        ])
         db.commit()
 
     # --- 2. 执行与验证 ---
-    with patch('src.bot.handlers._seed_rules_if_new_group', return_value=False):
-
+    # 直接统计发往 event_logs 的 COUNT 查询次数来验证缓存，而不是删除所有日志后再观察结果
+    mock_update.message.text = "/stats"
+    with count_queries() as statements:
         # 第一次调用，应该会查询数据库
-        mock_update.message.text = "/stats"
         await process_event("command", mock_update, mock_context)
         mock_update.effective_message.reply_text.assert_called_once_with("Messages in last 1 hour: 3")
         mock_update.effective_message.reply_text.reset_mock()
 
         # 第二次调用，应该使用缓存
-        # 为验证缓存，我们直接删除所有日志记录
-        with test_db_session_factory() as db:
-            db.query(EventLog).delete()
-            db.commit()
-
-        # 再次调用 process_event
-        # 如果缓存有效，它应该仍然返回 '3'，而不是从空的数据库中查询并返回 '0'
         await process_event("command", mock_update, mock_context)
-        mock_update.effective_message.reply_text.assert_called_once_with("Messages in last 1 hour: 3")
 
+    stats_queries = [stmt for stmt in statements if "count(event_logs.id)" in stmt]
+    assert len(stats_queries) == 1
+    # 第一次事件自身的日志已被提交；如果没有命中缓存，第二次的结果会变成 4
+    mock_update.effective_message.reply_text.assert_called_once_with("Messages in last 1 hour: 3")
 
-async def test_rule_priority_execution_order(mock_update, mock_context, test_db_session_factory):
+
+async def test_rule_priority_execution_order(mock_update, mock_context, rule_factory):
     """
     集成测试：验证具有不同优先级的规则是否按正确的顺序执行。
     """
     # --- 1. 准备阶段 (Setup) ---
-    with test_db_session_factory() as db:
-        db.add(Group(id=-1001, name="Test Group"))
-        # 低优先级规则
-        db.add(Rule(
-            group_id=-1001, name="Low Prio Rule", priority=5,
-            script="""WHEN message THEN { reply("low priority"); } END"""
-        ))
-        # 高优先级规则
-        db.add(Rule(
-            group_id=-1001, name="High Prio Rule", priority=10,
-            script="""WHEN message THEN { reply("high priority"); } END"""
-        ))
-        db.commit()
+    # 低优先级规则
+    rule_factory("""WHEN message THEN { reply("low priority"); } END""", name="Low Prio Rule", priority=5)
+    # 高优先级规则
+    rule_factory("""WHEN message THEN { reply("high priority"); } END""", name="High Prio Rule", priority=10)
 
     mock_update.effective_message.text = "trigger both"
 
     # --- 2. 执行阶段 (Act) ---
-    with patch('src.bot.handlers._seed_rules_if_new_group', return_value=False):
-        await process_event("message", mock_update, mock_context)
+    await process_event("message", mock_update, mock_context)
 
     # --- 3. 验证阶段 (Assert) ---
     # 验证 reply_text 被调用了两次
@@ -713,7 +782,7 @@ async def test_rule_priority_execution_order(mock_update, mock_context, test_db_
     assert calls[0].args[0] == "high priority"
     assert calls[1].args[0] == "low priority"
 
-async def test_full_lifecycle_simple_reply(mock_update, mock_context, test_db_session_factory):
+async def test_full_lifecycle_simple_reply(mock_update, mock_context, rule_factory):
     """
     测试一个完整的事件生命周期：
     1. 一个 "message" 事件被触发。
@@ -730,10 +799,7 @@ async def test_full_lifecycle_simple_reply(mock_update, mock_context, test_db_se
     }
     END
     """
-    with test_db_session_factory() as session:
-        session.add(Group(id=-1001, name="Test Group"))
-        session.add(Rule(group_id=-1001, name="Simple Reply Rule", script=script, is_active=True))
-        session.commit()
+    rule_factory(script, name="Simple Reply Rule")
 
     mock_update.message.text = "Hello world"
 
@@ -743,7 +809,7 @@ async def test_full_lifecycle_simple_reply(mock_update, mock_context, test_db_se
     # 3. 验证：检查 mock 的 bot API 是否被正确调用
     mock_update.effective_message.reply_text.assert_called_once_with("Hello to you too!")
 
-async def test_local_variable_precedence(mock_update, mock_context, test_db_session_factory):
+async def test_local_variable_precedence(mock_update, mock_context, rule_factory):
     """
     测试作用域优先级：验证脚本内的局部变量是否优先于同名的上下文变量。
     """
@@ -757,10 +823,7 @@ async def test_local_variable_precedence(mock_update, mock_context, test_db_sess
     }
     END
     """
-    with test_db_session_factory() as session:
-        session.add(Group(id=-1001, name="Test Group"))
-        session.add(Rule(group_id=-1001, name="Scope Test Rule", script=script, is_active=True))
-        session.commit()
+    rule_factory(script, name="Scope Test Rule")
 
     # 2. 执行
     await process_event("message", mock_update, mock_context)
@@ -768,7 +831,7 @@ async def test_local_variable_precedence(mock_update, mock_context, test_db_sess
     # 3. 验证：reply 动作应该使用局部变量 `user.id` (999)，而不是上下文中的 `user.id` (123)。
     mock_update.effective_message.reply_text.assert_called_once_with("User ID is 999")
 
-async def test_complex_foreach_with_control_flow(mock_update, mock_context, test_db_session_factory):
+async def test_complex_foreach_with_control_flow(mock_update, mock_context, rule_factory):
     """
     测试一个复杂的 foreach 循环，其中包含 if, break, continue 和对外部变量的修改。
     """
@@ -792,10 +855,7 @@ async def test_complex_foreach_with_control_flow(mock_update, mock_context, test
     }
     END
     """
-    with test_db_session_factory() as session:
-        session.add(Group(id=-1001, name="Test Group"))
-        session.add(Rule(group_id=-1001, name="Complex Loop Rule", script=script, is_active=True))
-        session.commit()
+    rule_factory(script, name="Complex Loop Rule")
 
     # 2. 执行
     await process_event("message", mock_update, mock_context)
@@ -807,7 +867,7 @@ async def test_complex_foreach_with_control_flow(mock_update, mock_context, test
     mock_update.effective_message.reply_text.assert_called_once_with("Total: 80, Count: 3")
 
 
-async def test_log_and_stop_interaction(mock_update, mock_context, test_db_session_factory):
+async def test_log_and_stop_interaction(mock_update, mock_context, test_db_session_factory, rule_factory):
     """
     集成测试：验证在同一个代码块中，`log` 动作在 `stop` 动作之前会被执行，
     而 `stop` 之后的动作则不会被执行。
@@ -820,10 +880,7 @@ async def test_log_and_stop_interaction(mock_update, mock_context, test_db_sessi
         reply("This should not be sent");
     } END
     """
-    with test_db_session_factory() as db:
-        db.add(Group(id=-1001, name="Test Group"))
-        db.add(Rule(group_id=-1001, name="Log and Stop Rule", script=script))
-        db.commit()
+    rule_factory(script, name="Log and Stop Rule")
 
     # --- 2. 执行 ---
     await process_event("message", mock_update, mock_context)
@@ -840,7 +897,7 @@ async def test_log_and_stop_interaction(mock_update, mock_context, test_db_sessi
         assert log_entry.actor_user_id == mock_update.effective_user.id
 
 
-async def test_complex_keyword_automute_scenario(mock_update, mock_context, test_db_session_factory):
+async def test_complex_keyword_automute_scenario(mock_update, mock_context, rule_factory):
     """
     一个复杂的端到端集成测试，模拟一个“关键词自动禁言”的系统。
     这个测试验证了：
@@ -852,7 +909,6 @@ async def test_complex_keyword_automute_scenario(mock_update, mock_context, test
     # --- 1. 准备阶段 (Setup) ---
     admin_id = 123
     offender_id = 456
-    group_id = -1001
 
     # 规则1: 管理员设置禁言关键词
     set_keyword_rule = """
@@ -872,43 +928,37 @@ async def test_complex_keyword_automute_scenario(mock_update, mock_context, test
     } END
     """
 
-    with test_db_session_factory() as db:
-        db.add(Group(id=group_id, name="Test Group"))
-        db.add(Rule(group_id=group_id, name="Set Keyword Rule", script=set_keyword_rule, priority=10))
-        db.add(Rule(group_id=group_id, name="Automute Rule", script=automute_rule, priority=5))
-        db.commit()
+    rule_factory(set_keyword_rule, name="Set Keyword Rule", priority=10)
+    rule_factory(automute_rule, name="Automute Rule", priority=5)
 
-    with patch('src.bot.handlers._seed_rules_if_new_group', return_value=False):
-        # --- 2. 管理员设置关键词 ---
-        mock_update.effective_user.id = admin_id
-        # 模拟 is_admin 的 API 调用
-        mock_context.bot.get_chat_member = AsyncMock(return_value=MagicMock(status='administrator'))
-        mock_update.message.text = "/set_forbidden secret"
-        # 关键：确保为这个 update 的 message 对象设置一个 mock reply_text
-        mock_update.message.reply_text = AsyncMock()
-        await process_event("command", mock_update, mock_context)
+    # --- 2. 管理员设置关键词 ---
+    mock_update.effective_user.id = admin_id
+    # 模拟 is_admin 的 API 调用
+    mock_context.bot.get_chat_member = AsyncMock(return_value=SimpleNamespace(status='administrator'))
+    mock_update.message.text = "/set_forbidden secret"
+    await process_event("command", mock_update, mock_context)
 
-        mock_update.message.reply_text.assert_called_once_with("禁言关键词已设置为: secret")
-        mock_update.message.reply_text.reset_mock()
+    mock_update.message.reply_text.assert_awaited_once_with("禁言关键词已设置为: secret")
+    mock_update.message.reply_text.reset_mock()
 
-        # --- 3. 违规用户发送消息并被禁言 ---
-        mock_update.effective_user.id = offender_id
-        mock_update.effective_user.first_name = "Offender"
-        mock_update.message.text = "I know the secret word!"
-        # 重置 mock，因为 mute_user 也会调用它
-        mock_context.bot.get_chat_member.reset_mock()
+    # --- 3. 违规用户发送消息并被禁言 ---
+    mock_update.effective_user.id = offender_id
+    mock_update.effective_user.first_name = "Offender"
+    mock_update.message.text = "I know the secret word!"
+    # 重置 mock，因为 mute_user 也会调用它
+    mock_context.bot.get_chat_member.reset_mock()
 
-        await process_event("message", mock_update, mock_context)
+    await process_event("message", mock_update, mock_context)
 
-        # 验证禁言动作
-        mock_context.bot.restrict_chat_member.assert_called_once()
-        _, kwargs = mock_context.bot.restrict_chat_member.call_args
-        assert kwargs['user_id'] == offender_id
-        assert not kwargs['permissions'].can_send_messages
-        assert (kwargs['until_date'] - datetime.now(timezone.utc)) > timedelta(seconds=50)
+    # 验证禁言动作
+    mock_context.bot.restrict_chat_member.assert_called_once()
+    _, kwargs = mock_context.bot.restrict_chat_member.call_args
+    assert kwargs['user_id'] == offender_id
+    assert not kwargs['permissions'].can_send_messages
+    assert (kwargs['until_date'] - datetime.now(timezone.utc)) > timedelta(seconds=50)
 
-        # 验证回复
-        mock_update.message.reply_text.assert_called_once_with("Offender，你因发送违禁词已被禁言1分钟。")
+    # 验证回复
+    mock_update.message.reply_text.assert_called_once_with("Offender，你因发送违禁词已被禁言1分钟。")
 
 
 async def test_verification_callback_wrong_user(mock_update, mock_context, test_db_session_factory):
@@ -938,67 +988,3 @@ async def test_verification_callback_wrong_user(mock_update, mock_context, test_
     # 2. 验证没有其他动作被执行（例如，没有编辑消息或解除禁言）
     mock_update.callback_query.edit_message_text.assert_not_called()
     mock_context.bot.restrict_chat_member.assert_not_called()
-
-
-async def test_verification_callback_malformed_data(mock_update, mock_context):
-    """
-    边界测试：验证当回调数据 (`callback_data`) 格式不正确或被篡改时的系统行为。
-    """
-    # --- 1. 准备阶段 (Setup) ---
-    mock_update.callback_query.data = "verify_invalid_data" # 格式错误的数据
-
-    # --- 2. 执行阶段 (Act) ---
-    await verification_callback_handler(mock_update, mock_context)
-
-    # --- 3. 验证阶段 (Assert) ---
-    # 验证机器人编辑了消息，提示错误
-    mock_update.callback_query.edit_message_text.assert_called_once_with(
-        text="回调数据格式错误，请重试。"
-    )
-    # 验证没有其他危险操作被执行
-    mock_context.bot.restrict_chat_member.assert_not_called()
-
-
-async def test_verification_callback_failure_and_kick(mock_update, mock_context, test_db_session_factory):
-    """
-    测试用户在最后一次机会也回答错误后，被踢出群组的流程。
-    """
-    # --- 1. 准备阶段 (Setup) ---
-    group_id = -1001
-    user_id = 123
-    correct_answer = "42"
-    wrong_answer = "99"
-
-    with test_db_session_factory() as db:
-        # 预置一个已经尝试了2次的验证记录
-        verification = Verification(
-            group_id=group_id,
-            user_id=user_id,
-            correct_answer=correct_answer,
-            attempts_made=3 # 这是第三次尝试
-        )
-        db.add(verification)
-        db.commit()
-
-    # 模拟用户点击了错误答案按钮
-    mock_update.callback_query.data = f"verify_{group_id}_{user_id}_{wrong_answer}"
-    mock_update.callback_query.from_user.id = user_id
-    mock_context.job_queue.get_jobs_by_name.return_value = []
-
-    # --- 2. 执行阶段 (Act) ---
-    await verification_callback_handler(mock_update, mock_context)
-
-    # --- 3. 验证阶段 (Assert) ---
-    # 1. 验证用户被踢出 (ban + unban)
-    mock_context.bot.ban_chat_member.assert_called_once_with(chat_id=group_id, user_id=user_id)
-    mock_context.bot.unban_chat_member.assert_called_once_with(chat_id=group_id, user_id=user_id)
-
-    # 2. 验证机器人编辑了消息，提示失败
-    mock_update.callback_query.edit_message_text.assert_called_once_with(
-        text="❌ 验证失败次数过多，您已被移出群组。"
-    )
-
-    # 3. 验证数据库中的记录已被删除
-    with test_db_session_factory() as db:
-        v = db.query(Verification).filter_by(user_id=user_id).first()
-        assert v is None
@@ -1,47 +1,36 @@
 # tests/test_main.py
-import asyncio
 import pytest
-from unittest.mock import AsyncMock, MagicMock, patch
-import importlib
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
 
-# Import the module we want to test
-main_module = importlib.import_module("main")
+from src.database import Group, Rule
+from cachetools import LRUCache
 
-from src.database import Base, Group, Rule, Log
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-
-# Use an in-memory SQLite DB for tests that need it
-TEST_DATABASE_URL = "sqlite:///:memory:"
-
-@pytest.fixture(scope="function")
-def test_db_session_factory():
-    """提供一个用于测试的、干净的内存 SQLite 数据库会话工厂。"""
-    engine = create_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False})
-    Base.metadata.create_all(engine)
-    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    yield factory
-    Base.metadata.drop_all(engine)
+# 被测模块 `main` 由 conftest 中的会话级 `main_module` fixture 提供；
+# 需要数据库的测试使用 conftest 中基于会话级内存引擎的 `test_db_session_factory`。
 
 
 @pytest.mark.asyncio
-@patch('main.os.getenv')
-@patch('main.logger.critical') # 直接修补 logger 实例
-async def test_main_exit_on_missing_env_vars(mock_logger_critical, mock_getenv):
+@pytest.mark.parametrize("missing_key, expected_msg", [
+    ("TELEGRAM_TOKEN", "关键错误: 未在环境变量中找到 TELEGRAM_TOKEN，机器人无法启动。"),
+    ("DATABASE_URL", "关键错误: 未在环境变量中找到 DATABASE_URL，机器人无法启动。"),
+])
+async def test_main_exit_on_missing_env_vars(monkeypatch, missing_key, expected_msg, main_module):
     """测试：当环境变量缺失时，main() 应记录一个严重错误并直接返回。"""
-    # 场景1：缺少 TELEGRAM_TOKEN
-    mock_getenv.side_effect = lambda key, default=None: None if key == "TELEGRAM_TOKEN" else "dummy_db_url"
-    await main_module.main()
-    mock_logger_critical.assert_called_with("关键错误: 未在环境变量中找到 TELEGRAM_TOKEN，机器人无法启动。")
+    # 跳过 load_dotenv 对 .env 文件的逐级目录查找，环境变量完全由下面的 setenv/delenv 决定
+    monkeypatch.setattr("main.load_dotenv", lambda: None)
+    monkeypatch.setenv("TELEGRAM_TOKEN", "dummy")
+    monkeypatch.setenv("DATABASE_URL", "dummy")
+    monkeypatch.delenv(missing_key)
+    mock_logger_critical = MagicMock()
+    monkeypatch.setattr("main.logger.critical", mock_logger_critical) # 直接修补 logger 实例
 
-    # Scenario 2: Missing DATABASE_URL
-    mock_getenv.side_effect = lambda key, default=None: "dummy_token" if key == "TELEGRAM_TOKEN" else None
     await main_module.main()
-    mock_logger_critical.assert_called_with("关键错误: 未在环境变量中找到 DATABASE_URL，机器人无法启动。")
+    mock_logger_critical.assert_called_once_with(expected_msg)
 
 
 @pytest.mark.asyncio
-async def test_load_scheduled_rules(test_db_session_factory):
+async def test_load_scheduled_rules(test_db_session_factory, main_module):
     """测试：`load_scheduled_rules` 函数应能正确加载规则并将其注册到调度器。"""
     # --- 1. 准备阶段 ---
     group = Group(id=-1001, name="Scheduler Test Group")
@@ -88,72 +77,90 @@ async def test_load_scheduled_rules(test_db_session_factory):
         assert call_kwargs['kwargs']['group_id'] == group_id
 
 
-@pytest.mark.asyncio
-@patch('main.asyncio.Future')
-@patch('main.Application.builder')
-@patch('main.init_database')
-@patch('main.get_session_factory')
-@patch('main.AsyncIOScheduler')
-@patch('main.load_scheduled_rules', new_callable=AsyncMock)
-@patch('main.os.getenv')
-@patch('main.JobQueue') # <--- 模拟 JobQueue
-async def test_main_full_run(mock_job_queue_class, mock_getenv, mock_load_rules, mock_scheduler_class, mock_get_session, mock_init_db, mock_app_builder, mock_asyncio_future):
+@pytest.fixture
+def mocked_main_env(monkeypatch):
     """
-    对 main() 函数的流程进行一次高层次的集成测试。
-    这个测试的关键是模拟 `asyncio.Future()`，以防止 `main` 函数无限期等待。
+    为 `main()` 构建完整的模拟运行环境：环境变量、数据库初始化、调度器、JobQueue 以及
+    `Application.builder()` 的链式调用。
+    所有替换都通过 `monkeypatch` 完成并在测试结束时自动恢复，测试本身只需调用 `main()` 并断言。
+    关键在于模拟 `asyncio.Future()`，以防止 `main` 函数无限期等待。
     """
-    # --- 1. 准备模拟对象 ---
-    mock_getenv.side_effect = lambda key, default=None: {
-        "TELEGRAM_TOKEN": "fake_token",
-        "DATABASE_URL": "sqlite:///:memory:"
-    }.get(key, default)
+    monkeypatch.setattr("main.load_dotenv", lambda: None)
+    monkeypatch.setenv("TELEGRAM_TOKEN", "fake_token")
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///:memory:")
+
+    init_database = MagicMock()
+    get_session_factory = MagicMock()
+    load_rules = AsyncMock()
+    monkeypatch.setattr("main.init_database", init_database)
+    monkeypatch.setattr("main.get_session_factory", get_session_factory)
+    monkeypatch.setattr("main.load_scheduled_rules", load_rules)
 
     # 模拟 AsyncIOScheduler 实例和它的 start 方法
-    mock_scheduler_instance = MagicMock()
-    mock_scheduler_class.return_value = mock_scheduler_instance
+    scheduler = MagicMock()
+    monkeypatch.setattr("main.AsyncIOScheduler", MagicMock(return_value=scheduler))
 
     # 模拟 JobQueue 实例
-    mock_job_queue_instance = MagicMock()
+    job_queue = MagicMock()
     # 核心修复：将模拟的 scheduler 实例赋给模拟的 job_queue 实例
-    mock_job_queue_instance.scheduler = mock_scheduler_instance
-    mock_job_queue_class.return_value = mock_job_queue_instance
+    job_queue.scheduler = scheduler
+    monkeypatch.setattr("main.JobQueue", MagicMock(return_value=job_queue))
 
     # 模拟 Application 实例
-    mock_app = AsyncMock()
-    mock_app.bot_data = {}
-    mock_app.add_handler = MagicMock()
-    mock_app.updater = AsyncMock()
+    app = AsyncMock()
+    app.bot_data = {}
+    app.add_handler = MagicMock()
+    app.updater = AsyncMock()
     # 核心修复：将模拟的 job_queue 实例赋给模拟的 application 实例
-    mock_app.job_queue = mock_job_queue_instance
+    app.job_queue = job_queue
 
     # 设置 Application.builder 链式调用以返回我们的 mock_app
-    mock_app_builder.return_value.token.return_value.job_queue.return_value.build.return_value = mock_app
+    builder = MagicMock()
+    builder.return_value.token.return_value.job_queue.return_value.build.return_value = app
+    monkeypatch.setattr("main.Application.builder", builder)
+
+    # 用 AsyncMock 代替 asyncio.Future：`await asyncio.Future()` 会立即返回 None，
+    # 既不会让出事件循环，也不会在测试提前失败时留下一个从未被 await 的协程。
+    future = AsyncMock(return_value=None)
+    monkeypatch.setattr("main.asyncio.Future", future)
 
-    # 确保对 asyncio.Future() 的调用返回一个真正的可等待对象(协程)。
-    mock_asyncio_future.return_value = asyncio.sleep(0)
+    return SimpleNamespace(
+        app=app, builder=builder, scheduler=scheduler, job_queue=job_queue,
+        init_database=init_database, get_session_factory=get_session_factory,
+        load_rules=load_rules, future=future,
+    )
+
+
+@pytest.mark.asyncio
+async def test_main_full_run(mocked_main_env, main_module):
+    """
+    对 main() 函数的流程进行一次高层次的集成测试。
+    模拟对象的构建见 `mocked_main_env`。
+    """
+    env = mocked_main_env
 
-    # --- 2. Execute ---
+    # --- 1. Execute ---
     await main_module.main()
 
-    # --- 3. Assert ---
-    mock_init_db.assert_called_once_with("sqlite:///:memory:")
-    mock_get_session.assert_called_once()
+    # --- 2. Assert ---
+    env.init_database.assert_called_once_with("sqlite:///:memory:")
+    env.get_session_factory.assert_called_once()
 
     # 核心修复：断言现在应该针对我们创建的 scheduler 实例
-    mock_scheduler_instance.start.assert_called_once()
+    env.scheduler.start.assert_called_once()
 
-    mock_app_builder.return_value.token.assert_called_once_with("fake_token")
-    mock_app_builder.return_value.token.return_value.job_queue.assert_called_once_with(mock_job_queue_instance)
+    env.builder.return_value.token.assert_called_once_with("fake_token")
+    env.builder.return_value.token.return_value.job_queue.assert_called_once_with(env.job_queue)
 
-    assert 'session_factory' in mock_app.bot_data
-    assert 'rule_cache' in mock_app.bot_data
+    assert 'session_factory' in env.app.bot_data
+    assert isinstance(env.app.bot_data['rule_cache'], LRUCache)
 
     # 验证启动逻辑是否被正确调用
-    mock_load_rules.assert_awaited_once()
+    env.load_rules.assert_awaited_once()
     # 在 `async with application:` 上下文中，start() 和 updater.start_polling() 不再需要手动调用
     # 因此我们移除对它们的断言
     # mock_app.start.assert_awaited_once()
     # mock_app.updater.start_polling.assert_awaited_once()
 
-    # 验证 `asyncio.Future()` 被调用，确认我们已经到达了主循环
-    mock_asyncio_future.assert_called_once()
+    # 验证 `asyncio.Future()` 被 await，确认我们已经到达了主循环
+    env.future.assert_awaited_once()
@@ -5,8 +5,9 @@ from src.core.parser import (
     RuleParser, ParsedRule, StatementBlock, Assignment, ActionCallStmt, Literal,
     Variable, BinaryOp, PropertyAccess, IndexAccess, ForEachStmt, IfStmt,
     RuleParserError, ListConstructor, DictConstructor, precompile_rule,
-    ActionCallExpr, BreakStmt, ContinueStmt
+    ActionCallExpr, BreakStmt, ContinueStmt, parse_rule
 )
+from src.bot.default_rules import DEFAULT_RULES
 
 # =================== 辅助函数 ===================
 
@@ -55,6 +56,13 @@ def test_tokenizer_all_tokens():
     assert 'NEWLINE' not in token_types
     assert 'MISMATCH' not in token_types
 
+def test_tokenizer_normalizes_operator_case():
+    """测试分词器将比较/逻辑运算符统一规范为小写，解析出的 BinaryOp.op 因此总是小写。"""
+    expr = parse_where_expr("a CONTAINS 'x' AND NOT b")
+    assert expr.op == "and"
+    assert expr.left.op == "contains"
+    assert expr.right.op == "not"
+
 def test_tokenizer_invalid_character():
     """测试分词器在遇到无效字符时是否会抛出异常。"""
     from src.core.parser import tokenize
@@ -80,6 +88,20 @@ def test_precompile_rule_invalid_input():
     assert is_valid is False
     assert "脚本不能为空" in error
 
+def test_parse_rule_caches_by_script():
+    """测试 parse_rule 对相同脚本返回同一个缓存的 AST，且不缓存解析错误。"""
+    parse_rule.cache_clear()
+    script = "WHEN message THEN { reply('cached'); } END"
+    first = parse_rule(script)
+    assert parse_rule(script) is first
+    assert parse_rule.cache_info().hits == 1
+
+    with pytest.raises(RuleParserError):
+        parse_rule("WHEN message THEN {")
+    with pytest.raises(RuleParserError):
+        parse_rule("WHEN message THEN {")
+    assert parse_rule.cache_info().currsize == 1
+
 def test_parse_empty_script_fails():
     """测试解析空脚本或只有空白的脚本会失败。"""
     with pytest.raises(RuleParserError):
@@ -179,6 +201,7 @@ def test_function_call_parsing():
     (r'"line1\n\tline2 \"quoted\" and a \\ backslash"', "line1\n\tline2 \"quoted\" and a \\ backslash"),
     (r"'line1\n\tline2 \'quoted\' and a \\ backslash'", "line1\n\tline2 'quoted' and a \\ backslash"),
     (r'"\u4f60\u597d"', "你好"), # Test unicode escapes
+    (r'"a \\z"', "a \\z"), # 转义的反斜杠后紧跟普通字符，不是无效转义
 ])
 def test_string_with_escape_characters_parsing(script_literal, expected_string):
     """测试解析器是否能正确处理字符串中的各种转义序列。"""
@@ -330,7 +353,6 @@ def test_default_rules_are_parsable():
     一个重要的健全性检查：确保所有在代码中定义的默认规则都是可解析的。
     这可以防止因修改解析器而意外破坏现有默认规则的情况。
     """
-    from src.bot.default_rules import DEFAULT_RULES
     for i, rule_data in enumerate(DEFAULT_RULES):
         script = rule_data["script"]
         try:
@@ -24,8 +24,28 @@ from cachetools import TTLCache
 # Mark all tests in this file as asyncio
 pytestmark = pytest.mark.asyncio
 
+@pytest.fixture(scope="module")
+def spec_update() -> Update:
+    """
+    提供作为 spec 的真实 `telegram.Update` 对象（及其嵌套的 User/Chat/Message）。
+    性能优化: PTB 对象在构造完成后即被冻结、不可修改，因此可以在本模块的所有测试之间安全共享，
+    只需构造一次；每个测试仍会由 `mock_update` 创建自己的 mock，互不影响。
+    """
+    # 创建真实的、最小化的嵌套对象
+    mock_user = User(id=123, is_bot=False, first_name="Test")
+    mock_chat = Chat(id=-1001, type="group")
+    # 关键修复：在 Message 中包含 from_user，这样 effective_user 就会被自动设置
+    mock_message = Message(message_id=1, date=datetime.now(timezone.utc), chat=mock_chat, text="", from_user=mock_user)
+
+    # 创建一个真实的 Update 对象作为 spec
+    # 现在我们不再需要（也不能）手动设置 effective_user 和 effective_chat
+    return Update(
+        update_id=999,
+        message=mock_message
+    )
+
 @pytest.fixture
-def mock_update() -> MagicMock:
+def mock_update(spec_update) -> MagicMock:
     """
     提供一个带有 spec 的 mock Update 对象。
 
@@ -39,19 +59,6 @@ def mock_update() -> MagicMock:
     从而解决了这个问题。这强制 mock 对象的行为与真实 `Update` 对象完全一致，
     确保了访问不存在的属性时会正确地触发 `AttributeError`，让我们的测试更加可靠和真实。
     """
-    # 创建真实的、最小化的嵌套对象
-    mock_user = User(id=123, is_bot=False, first_name="Test")
-    mock_chat = Chat(id=-1001, type="group")
-    # 关键修复：在 Message 中包含 from_user，这样 effective_user 就会被自动设置
-    mock_message = Message(message_id=1, date=datetime.now(timezone.utc), chat=mock_chat, text="", from_user=mock_user)
-
-    # 创建一个真实的 Update 对象作为 spec
-    spec_update = Update(
-        update_id=999,
-        message=mock_message
-    )
-    # 现在我们不再需要（也不能）手动设置 effective_user 和 effective_chat
-
     # 使用 autospec=True 创建 mock，它将从 spec_update 对象中自动推断规格
     mock = MagicMock(spec=spec_update, autospec=True)
 
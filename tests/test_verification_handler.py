@@ -1,9 +1,12 @@
 # tests/test_verification_handler.py
 
 import pytest
-from unittest.mock import MagicMock, AsyncMock, patch, ANY
+from unittest.mock import MagicMock, AsyncMock, patch, ANY, call
 
 from src.bot.handlers import verification_callback_handler
+from sqlalchemy import insert
+from telegram.error import TelegramError
+
 from src.database import Verification
 from src.utils import session_scope
 
@@ -18,6 +21,17 @@ def mock_callback_update():
     mock.callback_query.from_user = MagicMock()
     return mock
 
+@pytest.fixture
+def mock_context_no_db():
+    """
+    不依赖数据库的轻量 Context。
+    回调数据在解析阶段就被拒绝的测试不会访问会话工厂，因此无需 conftest 中的 `mock_context` 及其数据库 fixture。
+    """
+    context = MagicMock()
+    context.bot_data = {}
+    context.bot.restrict_chat_member = AsyncMock()
+    return context
+
 async def test_unit_verification_success_calls_util(mock_callback_update, mock_context, test_db_session_factory):
     """
     单元测试：验证用户点击正确答案后，会调用重构后的 unmute_user_util 工具函数。
@@ -26,7 +40,7 @@ async def test_unit_verification_success_calls_util(mock_callback_update, mock_c
 
     # 准备数据库
     with session_scope(test_db_session_factory) as db:
-        db.add(Verification(group_id=group_id, user_id=user_id, correct_answer=correct_answer, attempts_made=1))
+        db.execute(insert(Verification), [dict(group_id=group_id, user_id=user_id, correct_answer=correct_answer, attempts_made=1)])
 
     # 准备 Mocks
     mock_callback_update.callback_query.data = f"verify_{group_id}_{user_id}_{correct_answer}"
@@ -58,7 +72,7 @@ async def test_unit_verification_wrong_answer_with_retries(mock_callback_update,
     group_id, user_id, correct_answer, wrong_answer = -1001, 123, "42", "99"
 
     with session_scope(test_db_session_factory) as db:
-        db.add(Verification(group_id=group_id, user_id=user_id, correct_answer=correct_answer, attempts_made=1))
+        db.execute(insert(Verification), [dict(group_id=group_id, user_id=user_id, correct_answer=correct_answer, attempts_made=1)])
 
     mock_callback_update.callback_query.data = f"verify_{group_id}_{user_id}_{wrong_answer}"
     mock_callback_update.callback_query.from_user.id = user_id
@@ -85,7 +99,7 @@ async def test_unit_verification_failure_and_kick(mock_callback_update, mock_con
     group_id, user_id, correct_answer, wrong_answer = -1001, 123, "42", "99"
 
     with session_scope(test_db_session_factory) as db:
-        db.add(Verification(group_id=group_id, user_id=user_id, correct_answer=correct_answer, attempts_made=3))
+        db.execute(insert(Verification), [dict(group_id=group_id, user_id=user_id, correct_answer=correct_answer, attempts_made=3)])
 
     mock_callback_update.callback_query.data = f"verify_{group_id}_{user_id}_{wrong_answer}"
     mock_callback_update.callback_query.from_user.id = user_id
@@ -93,14 +107,39 @@ async def test_unit_verification_failure_and_kick(mock_callback_update, mock_con
 
     await verification_callback_handler(mock_callback_update, mock_context)
 
-    mock_context.bot.ban_chat_member.assert_called_once_with(chat_id=group_id, user_id=user_id)
-    mock_context.bot.unban_chat_member.assert_called_once_with(chat_id=group_id, user_id=user_id)
+    # 踢人必须先封禁再解封，否则用户会被永久封禁；一次比较同时验证顺序和没有多余的 API 调用
+    assert mock_context.bot.method_calls == [
+        call.ban_chat_member(chat_id=group_id, user_id=user_id),
+        call.unban_chat_member(chat_id=group_id, user_id=user_id),
+    ]
     mock_callback_update.callback_query.edit_message_text.assert_called_once_with(
         text="❌ 验证失败次数过多，您已被移出群组。"
     )
     with session_scope(test_db_session_factory) as db:
         assert db.query(Verification).count() == 0
 
+async def test_unit_verification_failure_edit_error_skips_kick(mock_callback_update, mock_context, test_db_session_factory):
+    """
+    单元测试：最后一次回答错误时，如果编辑提示消息失败，则不会踢出用户，
+    事务回滚后验证记录及其尝试次数保持不变。
+    """
+    group_id, user_id, correct_answer, wrong_answer = -1001, 123, "42", "99"
+
+    with session_scope(test_db_session_factory) as db:
+        db.execute(insert(Verification), [dict(group_id=group_id, user_id=user_id, correct_answer=correct_answer, attempts_made=3)])
+
+    mock_callback_update.callback_query.data = f"verify_{group_id}_{user_id}_{wrong_answer}"
+    mock_callback_update.callback_query.from_user.id = user_id
+    mock_callback_update.callback_query.edit_message_text.side_effect = TelegramError("Message is not modified")
+
+    with pytest.raises(TelegramError):
+        await verification_callback_handler(mock_callback_update, mock_context)
+
+    mock_context.bot.ban_chat_member.assert_not_called()
+    mock_context.bot.unban_chat_member.assert_not_called()
+    with session_scope(test_db_session_factory) as db:
+        assert db.query(Verification).one().attempts_made == 3
+
 async def test_unit_verification_wrong_user(mock_callback_update, mock_context):
     """
     单元测试：验证一个用户试图为另一个用户完成验证时的系统行为。
@@ -117,15 +156,29 @@ async def test_unit_verification_wrong_user(mock_callback_update, mock_context):
     assert kwargs['show_alert'] is True
     mock_callback_update.callback_query.edit_message_text.assert_not_called()
 
-async def test_unit_verification_malformed_data(mock_callback_update, mock_context):
+async def test_unit_verification_malformed_data(mock_callback_update, mock_context_no_db):
     """
     单元测试：验证当回调数据格式不正确时的系统行为。
     """
     mock_callback_update.callback_query.data = "verify_invalid_data"
 
-    await verification_callback_handler(mock_callback_update, mock_context)
+    await verification_callback_handler(mock_callback_update, mock_context_no_db)
+
+    mock_callback_update.callback_query.edit_message_text.assert_called_once_with(
+        text="回调数据格式错误，请重试。"
+    )
+    mock_context_no_db.bot.restrict_chat_member.assert_not_called()
+
+async def test_unit_verification_unknown_prefix(mock_callback_update, mock_context_no_db):
+    """
+    单元测试：验证回调数据的前缀不是 `verify` 时，按格式错误处理，不会查询或修改任何验证记录。
+    """
+    mock_callback_update.callback_query.data = "other_-1001_123_42"
+    mock_callback_update.callback_query.from_user.id = 123
+
+    await verification_callback_handler(mock_callback_update, mock_context_no_db)
 
     mock_callback_update.callback_query.edit_message_text.assert_called_once_with(
         text="回调数据格式错误，请重试。"
     )
-    mock_context.bot.restrict_chat_member.assert_not_called()
+    mock_context_no_db.bot.restrict_chat_member.assert_not_called()